@@ -0,0 +1,183 @@
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""In-process stand-in for papyon.Client, good enough to drive a
+ButterflyConnection through login and presence changes without a
+network."""
+
+import papyon
+import papyon.event
+
+__all__ = ['FakeClient', 'FakeContact', 'FakeGroup']
+
+
+class FakeClientCapabilities(object):
+    def __init__(self, supports_sip_invite=False, has_webcam=False):
+        self.supports_sip_invite = supports_sip_invite
+        self.has_webcam = has_webcam
+        self.supports_rtc_video = has_webcam
+
+
+class FakeContact(object):
+    def __init__(self, account, network_id=papyon.NetworkID.MSN,
+            memberships=papyon.Membership.FORWARD | papyon.Membership.ALLOW,
+            groups=()):
+        self.account = account
+        self.network_id = network_id
+        self.memberships = memberships
+        self.groups = set(groups)
+        self.presence = papyon.Presence.OFFLINE
+        self.personal_message = ""
+        self.display_name = account.split('@', 1)[0]
+        self.infos = {}
+        self.attributes = {}
+        self.msn_object = None
+        self.client_capabilities = FakeClientCapabilities()
+
+    def is_member(self, memberships):
+        return self.memberships & memberships
+
+
+class FakeGroup(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeContactList(list):
+    def search_by_groups(self, *groups):
+        return [contact for contact in self
+                if contact.groups.intersection(groups)]
+
+
+class FakeAddressBook(object):
+    def __init__(self, client):
+        self._client = client
+        self.contacts = FakeContactList()
+        self.groups = []
+        self._index = {}
+
+    def add(self, contact):
+        self.contacts.append(contact)
+        self._index[contact.account.lower(), contact.network_id] = contact
+
+    def search_contact(self, account, network_id):
+        return self._index.get((account.lower(), network_id), None)
+
+    def add_group(self, name):
+        group = FakeGroup(name)
+        self.groups.append(group)
+        self._client.dispatch('on_addressbook_group_added', group)
+
+    def update_contact_infos(self, contact, infos, done_cb=None,
+            failed_cb=None):
+        contact.infos.update(infos)
+        self._client.dispatch('on_contact_infos_changed', contact, infos)
+        if done_cb is not None:
+            done_cb[0](*done_cb[1:])
+
+    def add_contact_to_group(self, group, contact):
+        contact.groups.add(group)
+        self._client.dispatch('on_addressbook_group_contact_added', group,
+                contact)
+
+    def delete_contact_from_group(self, group, contact):
+        contact.groups.discard(group)
+        self._client.dispatch('on_addressbook_group_contact_deleted', group,
+                contact)
+
+
+class FakeProfile(FakeContact):
+    def __init__(self, account):
+        FakeContact.__init__(self, account, memberships=0)
+        self.client_id = FakeClientCapabilities()
+        self.profile = {'EmailEnabled': '0'}
+        self.end_point_name = ""
+
+
+class FakeMSNObjectStore(object):
+    def request(self, msn_object, callback, errback=None, peer=None):
+        callback[0](msn_object, *callback[1:])
+
+
+class FakeOfflineMessagesBox(object):
+    def fetch_messages(self, messages):
+        pass
+
+
+class FakeMailbox(object):
+    unread_mail_count = 0
+
+
+class FakeClient(papyon.event.EventsDispatcher):
+    """Replacement for papyon.Client. populate() fills the address book,
+    login() walks the connection through the same states papyon does and
+    churn() replays presence changes. Event interfaces register with it
+    the same way they do with papyon.Client."""
+
+    def __init__(self, server=None, proxies=None, transport_class=None,
+            version=None):
+        papyon.event.EventsDispatcher.__init__(self)
+        self.state = papyon.event.ClientState.CLOSED
+        self.profile = FakeProfile("butterfly@hotmail.com")
+        self.address_book = FakeAddressBook(self)
+        self.msn_object_store = FakeMSNObjectStore()
+        self.oim_box = FakeOfflineMessagesBox()
+        self.mailbox = FakeMailbox()
+        self.local_ip = "127.0.0.1"
+        self._churn_count = 0
+
+    def dispatch(self, name, *args):
+        self._dispatch(name, *args)
+
+    def populate(self, roster_size, group_count=0):
+        groups = [FakeGroup("Group %d" % i) for i in range(group_count)]
+        self.address_book.groups.extend(groups)
+        for i in xrange(roster_size):
+            contact_groups = ()
+            if groups:
+                contact_groups = (groups[i % len(groups)],)
+            contact = FakeContact("contact%d@hotmail.com" % i,
+                    groups=contact_groups)
+            contact.client_capabilities = FakeClientCapabilities(
+                    supports_sip_invite=(i % 3 == 0), has_webcam=(i % 6 == 0))
+            self.address_book.add(contact)
+
+    def _set_state(self, state):
+        self.state = state
+        self.dispatch('on_client_state_changed', state)
+
+    def login(self, account=None, password=None):
+        self._set_state(papyon.event.ClientState.CONNECTING)
+        self._set_state(papyon.event.ClientState.SYNCHRONIZED)
+        self._set_state(papyon.event.ClientState.OPEN)
+
+    def logout(self):
+        self._set_state(papyon.event.ClientState.CLOSED)
+
+    def churn(self, count):
+        """Change the presence and personal message of count contacts,
+        the way a burst of NLN/UBX commands from the server would."""
+        presences = (papyon.Presence.ONLINE, papyon.Presence.AWAY,
+                papyon.Presence.BUSY, papyon.Presence.IDLE)
+        contacts = self.address_book.contacts
+        for i in xrange(count):
+            self._churn_count += 1
+            contact = contacts[self._churn_count % len(contacts)]
+            contact.presence = presences[self._churn_count % len(presences)]
+            contact.personal_message = "message %d" % self._churn_count
+            self.dispatch('on_contact_presence_changed', contact)
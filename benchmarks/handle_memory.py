@@ -0,0 +1,108 @@
+#!/usr/bin/python
+#
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Compare the memory used by contact handles with the layout butterfly
+used to have (instance __dict__, eager pending_groups set, separate account
+string).
+
+Usage: handle_memory.py [count]"""
+
+import gc
+import os
+import sys
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import telepathy
+import papyon
+
+from butterfly.handle import ButterflyHandleFactory
+
+
+class LegacyContactHandle(telepathy.server.Handle):
+    """The contact handle as it was before it got __slots__."""
+
+    def __init__(self, connection, id, contact_name):
+        telepathy.server.Handle.__init__(self, id,
+                telepathy.HANDLE_TYPE_CONTACT, contact_name)
+        self._conn = weakref.proxy(connection)
+        self._contact = None
+        self.account = contact_name.lower()
+        self.network = papyon.NetworkID.MSN
+        self.pending_groups = set()
+        self.pending_alias = None
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self._handles = {}
+
+
+def footprint(obj, shared):
+    """Bytes owned by obj: the instance itself, its __dict__ if it has one
+    and the containers and strings hanging off it which aren't in shared."""
+    size = sys.getsizeof(obj)
+    referents = gc.get_referents(obj)
+    for referent in list(referents):
+        if isinstance(referent, dict):
+            referents.extend(referent.values())
+    for referent in referents:
+        if id(referent) in shared or isinstance(referent, type):
+            continue
+        if isinstance(referent, (dict, set, frozenset, basestring)):
+            shared.add(id(referent))
+            size += sys.getsizeof(referent)
+    return size
+
+
+def measure(build, count):
+    connection = FakeConnection()
+    names = [u"contact%d@hotmail.com" % i for i in xrange(count)]
+    proxy = weakref.proxy(connection)
+    shared = set(id(name) for name in names)
+    shared.add(id(proxy))
+
+    handles = [build(connection, i + 1, name) for i, name in enumerate(names)]
+    total = sum(footprint(handle, shared) for handle in handles)
+    return total, handles
+
+
+def main(count):
+    legacy, _ = measure(LegacyContactHandle, count)
+    compact, handles = measure(lambda conn, id, name:
+            ButterflyHandleFactory(conn, telepathy.HANDLE_TYPE_CONTACT,
+                id, name), count)
+
+    # Make sure nothing sneaked into an instance __dict__
+    assert not [r for r in gc.get_referents(handles[0]) if isinstance(r, dict)]
+
+    print "%d contact handles" % count
+    print "  legacy:  %9d bytes (%d bytes/handle)" % (legacy, legacy / count)
+    print "  compact: %9d bytes (%d bytes/handle)" % (compact, compact / count)
+    print "  saved:   %9d bytes (%.1f%%)" % (legacy - compact,
+            100.0 * (legacy - compact) / legacy)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main(10000)
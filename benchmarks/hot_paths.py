@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Time the connection hot paths at several roster sizes.
+
+A ButterflyConnection is created through the connection manager as usual,
+but papyon.Client is replaced by the in-process FakeClient so the roster,
+its groups and the presence churn are all synthetic. The connection still
+exports its objects on D-Bus, so run this on a private session bus:
+
+    dbus-launch python benchmarks/hot_paths.py --output after.json
+    dbus-launch python benchmarks/hot_paths.py --compare before.json
+
+Timings are the best of --repeat runs, in seconds."""
+
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import dbus
+import dbus.mainloop.glib
+import gobject
+import telepathy
+import papyon
+
+from fake_client import FakeClient
+papyon.Client = FakeClient
+
+from butterfly.connection_manager import ButterflyConnectionManager
+from butterfly.channel.contact_list import ButterflySubscribeListChannel
+from butterfly.channel_manager import escape_as_identifier
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+
+def drain():
+    """Run the main loop until the idle callbacks queued so far are done."""
+    context = gobject.main_context_default()
+    while context.pending():
+        context.iteration(False)
+
+
+def best_of(repeat, func, setup=None):
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def connect(manager, roster_size, group_count):
+    account = u"bench%d@hotmail.com" % roster_size
+    bus_name, path = manager.RequestConnection('msn',
+            {'account': account, 'password': u"password"})
+    conn = [c for c in manager._connections if c._object_path == path][0]
+    conn.msn_client.populate(roster_size, group_count)
+    conn.Connect()
+    drain()
+    return conn
+
+
+def run(manager, roster_size, options):
+    conn = connect(manager, roster_size, options.groups)
+    client = conn.msn_client
+    contacts = list(client.address_book.contacts)
+    handles = [conn.ensure_contact_handle(contact) for contact in contacts]
+    handle_ids = [handle.id for handle in handles]
+    subscribe = [channel for channel in conn._channels
+            if isinstance(channel, ButterflySubscribeListChannel)][0]
+    interfaces = [telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE,
+            telepathy.CONNECTION_INTERFACE_ALIASING,
+            telepathy.CONNECTION_INTERFACE_AVATARS,
+            telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES]
+    client.churn(roster_size)
+    drain()
+
+    def get_contact_attributes():
+        conn.GetContactAttributes(handle_ids, interfaces, False, ':1.0')
+
+    def get_simple_presences():
+        conn.get_simple_presences(handle_ids)
+
+    def populate():
+        subscribe._populate(conn)
+        drain()
+
+    def populate_capabilities():
+        conn._start_populating_capabilities()
+        drain()
+
+    def ensure_contact_handle():
+        for contact in contacts:
+            conn.ensure_contact_handle(contact)
+
+    def escape_identifiers():
+        for handle in handles:
+            escape_as_identifier(handle.name)
+
+    def churn():
+        client.churn(roster_size)
+        drain()
+
+    repeat = options.repeat
+    results = {
+        'GetContactAttributes': best_of(repeat, get_contact_attributes,
+                conn._invalidate_all_contact_attributes),
+        'GetContactAttributes (cached)': best_of(repeat,
+                get_contact_attributes),
+        'get_simple_presences': best_of(repeat, get_simple_presences),
+        '_populate': best_of(repeat, populate),
+        '_populate_capabilities': best_of(repeat, populate_capabilities),
+        'ensure_contact_handle': best_of(repeat, ensure_contact_handle),
+        'escape_as_identifier': best_of(repeat, escape_identifiers),
+        'presence churn': best_of(repeat, churn),
+    }
+
+    conn.Disconnect()
+    drain()
+    return results
+
+
+def compare(before, after):
+    for name in sorted(after['results']):
+        print name
+        for size in sorted(after['results'][name], key=int):
+            new = after['results'][name][size]
+            old = before['results'].get(name, {}).get(size)
+            if old:
+                print "  %6s: %9.4fs -> %9.4fs (x%.2f)" % (size, old, new,
+                        old / new if new else float('inf'))
+            else:
+                print "  %6s: %9.4fs" % (size, new)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [size...]")
+    parser.add_option('--groups', type='int', default=20,
+            help="number of groups in the address book")
+    parser.add_option('--repeat', type='int', default=5,
+            help="number of runs of each benchmark")
+    parser.add_option('--output', metavar='FILE',
+            help="write the results as JSON to FILE")
+    parser.add_option('--compare', metavar='FILE',
+            help="compare with the JSON results in FILE")
+    options, args = parser.parse_args()
+    sizes = [int(arg) for arg in args] or DEFAULT_SIZES
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    manager = ButterflyConnectionManager()
+
+    results = {}
+    for size in sizes:
+        for name, timing in run(manager, size, options).iteritems():
+            results.setdefault(name, {})[str(size)] = timing
+
+    report = {'python': platform.python_version(),
+            'groups': options.groups,
+            'repeat': options.repeat,
+            'results': results}
+
+    if options.output:
+        output = open(options.output, 'w')
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.close()
+    if options.compare:
+        compare(json.load(open(options.compare)), report)
+    elif not options.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
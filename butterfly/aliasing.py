@@ -17,6 +17,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import logging
+import weakref
 
 import dbus
 import telepathy
@@ -25,12 +26,16 @@ import papyon
 from papyon.service.description.AB.constants import \
     ContactGeneral, ContactAnnotations
 
-from butterfly.util.decorator import async
+from butterfly.util.aggregator import Aggregator
 
 __all__ = ['ButterflyAliasing']
 
 logger = logging.getLogger('Butterfly.Aliasing')
 
+# Milliseconds during which contact aliases set by clients are collected
+# before being written to the address book
+ALIAS_WRITE_DELAY = 500
+
 class ButterflyAliasing(
         telepathy.server.ConnectionInterfaceAliasing,
         papyon.event.ContactEventInterface,
@@ -41,19 +46,34 @@ class ButterflyAliasing(
         papyon.event.ContactEventInterface.__init__(self, self.msn_client)
         papyon.event.ProfileEventInterface.__init__(self, self.msn_client)
 
+        # handle -> alias last given out in AliasesChanged
+        self._signalled_aliases = weakref.WeakKeyDictionary()
+
+        # handle -> alias to write to the address book
+        self._alias_writes = Aggregator(self._write_aliases,
+                ALIAS_WRITE_DELAY)
+
+        # handle -> alias whose address book update is in flight
+        self._aliases_in_flight = weakref.WeakKeyDictionary()
+
     def GetAliasFlags(self):
         return telepathy.constants.CONNECTION_ALIAS_FLAG_USER_SET
 
     def RequestAliases(self, contacts):
         logger.debug("Called RequestAliases")
-        return [self._get_alias(handle_id) for handle_id in contacts]
+        handle_type = telepathy.HANDLE_TYPE_CONTACT
+        interface = telepathy.CONNECTION_INTERFACE_ALIASING
+        return [self._get_contact_attribute(self.handle(handle_type, handle_id),
+                    interface) for handle_id in contacts]
 
     def GetAliases(self, contacts):
         logger.debug("Called GetAliases")
 
         result = dbus.Dictionary(signature='us')
         for contact in contacts:
-            result[contact] = self._get_alias(contact)
+            handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, contact)
+            result[contact] = self._get_contact_attribute(handle,
+                    telepathy.CONNECTION_INTERFACE_ALIASING)
         return result
 
     def SetAliases(self, aliases):
@@ -62,33 +82,36 @@ class ButterflyAliasing(
             if handle != self._self_handle:
                 if alias == handle.name:
                     alias = u""
+                # The alias is written once the contact is in our contact
+                # list, until then it only lives in the handle
+                handle.pending_alias = alias
+                self._invalidate_contact_attributes(handle,
+                        telepathy.CONNECTION_INTERFACE_ALIASING)
                 contact = handle.contact
-                if contact is None or \
-                        (not contact.is_member(papyon.Membership.FORWARD)):
-                    handle.pending_alias = alias
-                    continue
-
-                new_alias = alias.encode("utf-8")
-                old_alias = contact.infos.get(ContactGeneral.ANNOTATIONS, {}).\
-                    get(ContactAnnotations.NICKNAME, None)
-                if new_alias == old_alias:
-                    continue
-
-                infos = {ContactGeneral.ANNOTATIONS :
-                            {ContactAnnotations.NICKNAME : new_alias}
-                        }
-                self.msn_client.address_book.update_contact_infos(contact, infos)
+                if contact is not None and \
+                        contact.is_member(papyon.Membership.FORWARD):
+                    self._alias_writes.add(handle, alias)
             else:
-                self.msn_client.profile.display_name = alias.encode('utf-8')
+                self._profile_publisher.set(display_name=alias.encode('utf-8'))
+                self._invalidate_contact_attributes(self._self_handle,
+                        telepathy.CONNECTION_INTERFACE_ALIASING)
                 logger.info("Self alias changed to '%s'" % alias)
-                self.AliasesChanged(((self._self_handle, alias), ))
+                self._contact_attribute_changed(self._self_handle,
+                        telepathy.CONNECTION_INTERFACE_ALIASING)
 
     # papyon.event.ContactEventInterface
     def on_contact_display_name_changed(self, contact):
+        handle = self.ensure_contact_handle(contact)
+        self._invalidate_contact_attributes(handle,
+                telepathy.CONNECTION_INTERFACE_ALIASING)
         self._contact_alias_changed(contact)
 
     # papyon.event.ContactEventInterface
     def on_contact_infos_changed(self, contact, updated_infos):
+        handle = self.ensure_contact_handle(contact)
+        self._invalidate_contact_attributes(handle,
+                telepathy.CONNECTION_INTERFACE_ALIASING)
+
         alias = updated_infos.get(ContactGeneral.ANNOTATIONS, {}).\
             get(ContactAnnotations.NICKNAME, None)
 
@@ -100,23 +123,21 @@ class ButterflyAliasing(
         handle = self.ensure_contact_handle(contact)
         if contact.is_member(papyon.Membership.FORWARD):
             alias = handle.pending_alias
-            if alias is not None:
-                infos = {ContactGeneral.ANNOTATIONS : \
-                            {ContactAnnotations.NICKNAME : alias.encode('utf-8')}
-                        }
-                self.msn_client.address_book.\
-                    update_contact_infos(contact, infos)
-                handle.pending_alias = None
+            # Don't queue the alias again while it is being written
+            if alias is not None and \
+                    self._aliases_in_flight.get(handle) != alias:
+                self._alias_writes.add(handle, alias)
 
     # papyon.event.ProfileEventInterface
     def on_profile_display_name_changed(self):
+        self._invalidate_contact_attributes(self._self_handle,
+                telepathy.CONNECTION_INTERFACE_ALIASING)
         self._contact_alias_changed(self.msn_client.profile)
 
-    def _get_alias(self, handle_id):
-        """Get the alias from one handle id"""
-        handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, handle_id)
+    def _get_alias(self, handle):
+        """Get the alias of one handle"""
         if handle == self._self_handle:
-            display_name = self.msn_client.profile.display_name
+            display_name = self._profile_publisher.get('display_name')
             if display_name == "":
                 display_name = handle.get_name().split('@', 1)[0]
                 display_name = display_name.replace("_", " ")
@@ -135,19 +156,89 @@ class ButterflyAliasing(
                 alias = unicode(alias, 'utf-8')
         return alias
 
-    @async
-    def _contact_alias_changed(self, contact):
-        alias = None
-
-        handle = self.ensure_contact_handle(contact)
-        if handle != self._self_handle:
-            alias = contact.infos.get(ContactGeneral.ANNOTATIONS, {}).\
+    def _write_aliases(self, aliases):
+        """Write the aliases collected by SetAliases to the address book,
+        one update per contact whose nickname actually changes."""
+        address_book = self.msn_client.address_book
+        written = 0
+        for handle, alias in aliases.iteritems():
+            contact = handle.contact
+            if contact is None or \
+                    not contact.is_member(papyon.Membership.FORWARD):
+                continue # still pending, written when the contact is added
+            if self._aliases_in_flight.get(handle) == alias:
+                continue # already being written
+
+            new_alias = alias.encode("utf-8")
+            old_alias = contact.infos.get(ContactGeneral.ANNOTATIONS, {}).\
                 get(ContactAnnotations.NICKNAME, None)
+            if new_alias == old_alias or (not new_alias and not old_alias):
+                self._alias_written(handle, alias)
+                continue
+
+            infos = {ContactGeneral.ANNOTATIONS :
+                        {ContactAnnotations.NICKNAME : new_alias}
+                    }
+            done_cb, failed_cb = self._alias_write_callbacks(handle, alias,
+                    contact)
+            self._aliases_in_flight[handle] = alias
+            address_book.update_contact_infos(contact, infos, done_cb,
+                    failed_cb)
+            written += 1
+        logger.debug("Writing %d of %d contact aliases" % (written,
+            len(aliases)))
+
+    def _alias_write_callbacks(self, handle, alias, contact):
+        def done(*args):
+            self._alias_write_done(handle, alias)
+            self._alias_written(handle, alias)
+        def failed(*args):
+            self._alias_write_done(handle, alias)
+            self._alias_write_failed(handle, alias, contact)
+        return (done,), (failed,)
+
+    def _alias_write_done(self, handle, alias):
+        if self._aliases_in_flight.get(handle) == alias:
+            del self._aliases_in_flight[handle]
+
+    def _alias_written(self, handle, alias):
+        # Don't forget a newer alias set while this one was being written
+        if handle.pending_alias == alias:
+            handle.pending_alias = None
+            self._invalidate_contact_attributes(handle,
+                    telepathy.CONNECTION_INTERFACE_ALIASING)
+
+    def _alias_write_failed(self, handle, alias, contact):
+        logger.warning("Failed to set the alias of %s to '%s'" %
+                (unicode(handle), alias))
+        if handle.pending_alias == alias:
+            handle.pending_alias = None
+            self._invalidate_contact_attributes(handle,
+                    telepathy.CONNECTION_INTERFACE_ALIASING)
+            # Give the alias from the address book back to the clients
+            self._signalled_aliases.pop(handle, None)
+            self._contact_alias_changed(contact)
 
-        if alias == "" or alias is None:
-            alias = contact.display_name
-
-        alias = unicode(alias, 'utf-8')
-        logger.info("Contact %s alias changed to '%s'" % (unicode(handle), alias))
-        self.AliasesChanged([(handle, alias)])
+    def _contact_alias_changed(self, contact):
+        handle = self.ensure_contact_handle(contact)
+        self._contact_attribute_changed(handle,
+                telepathy.CONNECTION_INTERFACE_ALIASING)
+
+    def _signal_aliases_changed(self, handles):
+        aliases = []
+        for handle in handles:
+            alias = self._get_contact_attribute(handle,
+                    telepathy.CONNECTION_INTERFACE_ALIASING)
+
+            # Display name and infos changes don't always change the alias
+            if self._signalled_aliases.get(handle) == alias:
+                continue
+
+            logger.info("Contact %s alias changed to '%s'" %
+                    (unicode(handle), alias))
+            self._signalled_aliases[handle] = alias
+            aliases.append((handle, alias))
+
+        if aliases:
+            self.AliasesChanged(aliases)
 
@@ -0,0 +1,157 @@
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import logging
+import os
+import string
+
+__all__ = ['ButterflyAvatarCache']
+
+logger = logging.getLogger('Butterfly.AvatarCache')
+
+# Bytes the cached avatars may use before the least recently used ones are
+# removed
+AVATAR_CACHE_SIZE = 20 * 1024 * 1024
+
+# Extensions of the files the cache considers avatars, the image types imghdr
+# may detect
+IMAGE_TYPES = frozenset(['png', 'jpeg', 'gif', 'bmp', 'tiff', 'webp', 'rgb',
+    'pbm', 'pgm', 'ppm', 'rast', 'xbm'])
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    # Not telepathy/avatars/butterfly/msn, which clients use for their own
+    # avatar cache in a different layout
+    return os.path.join(cache_home, 'telepathy-butterfly', 'avatars')
+
+
+class ButterflyAvatarCache(object):
+    """Avatars stored on disk by token, the hex SHA1 of their data.
+
+    Each avatar is a file named <token>.<image type>, the least recently
+    used ones being removed once they take more than max_size bytes. I/O
+    errors are logged and make the cache behave as if it was empty."""
+
+    def __init__(self, path=None, max_size=AVATAR_CACHE_SIZE):
+        if path is None:
+            path = default_cache_path()
+        self._path = path
+        self._max_size = max_size
+        self._index = None # token -> [filename, size, last use]
+        self._size = 0
+
+    def __contains__(self, token):
+        return token in self._get_index()
+
+    def get(self, token):
+        """Return the (data, mime type) of the avatar with this token, None
+        if it isn't cached."""
+        entry = self._get_index().get(token)
+        if entry is None:
+            return None
+
+        filename = os.path.join(self._path, entry[0])
+        try:
+            avatar = open(filename, 'rb')
+            try:
+                data = avatar.read()
+            finally:
+                avatar.close()
+            os.utime(filename, None)
+        except (IOError, OSError), e:
+            logger.warning("Failed to read cached avatar %s: %s" % (token, e))
+            self._forget(token)
+            return None
+
+        entry[2] = os.path.getmtime(filename)
+        image_type = entry[0].rsplit('.', 1)[1]
+        return data, 'image/' + image_type
+
+    def put(self, token, data, mime_type):
+        if not self._valid_token(token) or token in self._get_index():
+            return
+
+        image_type = mime_type.split('/', 1)[-1]
+        if image_type not in IMAGE_TYPES:
+            return
+        filename = '%s.%s' % (token, image_type)
+        path = os.path.join(self._path, filename)
+        temporary = path + '.tmp'
+        try:
+            if not os.path.isdir(self._path):
+                os.makedirs(self._path, 0700)
+            avatar = open(temporary, 'wb')
+            try:
+                avatar.write(data)
+            finally:
+                avatar.close()
+            os.rename(temporary, path)
+        except (IOError, OSError), e:
+            logger.warning("Failed to cache avatar %s: %s" % (token, e))
+            return
+
+        self._index[token] = [filename, len(data), os.path.getmtime(path)]
+        self._size += len(data)
+        self._evict()
+
+    def _valid_token(self, token):
+        return bool(token) and token.strip(string.hexdigits) == ''
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {}
+            self._size = 0
+            try:
+                filenames = os.listdir(self._path)
+            except OSError:
+                filenames = []
+            for filename in filenames:
+                token, _, image_type = filename.partition('.')
+                if not self._valid_token(token) or \
+                        image_type not in IMAGE_TYPES:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self._path, filename))
+                except OSError:
+                    continue
+                self._index[token] = [filename, stat.st_size, stat.st_mtime]
+                self._size += stat.st_size
+            self._evict()
+        return self._index
+
+    def _forget(self, token):
+        entry = self._index.pop(token, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _evict(self):
+        if self._size <= self._max_size:
+            return
+        entries = sorted(self._index.items(), key=lambda item: item[1][2])
+        for token, (filename, size, last_use) in entries:
+            if self._size <= self._max_size:
+                break
+            try:
+                os.remove(os.path.join(self._path, filename))
+            except OSError, e:
+                logger.warning("Failed to remove cached avatar %s: %s" %
+                        (token, e))
+            self._forget(token)
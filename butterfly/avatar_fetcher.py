@@ -0,0 +1,148 @@
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import logging
+import weakref
+from collections import deque
+
+import gobject
+
+__all__ = ['ButterflyAvatarFetcher']
+
+logger = logging.getLogger('Butterfly.AvatarFetcher')
+
+# Number of avatars downloaded at the same time
+MAX_AVATAR_FETCHES = 4
+
+# Seconds after which a download is given up, freeing its slot
+AVATAR_FETCH_TIMEOUT = 60
+
+
+class ButterflyAvatarFetcher(object):
+    """Download avatars from the MSN object store, at most max_fetches at a
+    time.
+
+    Handles waiting for the same token share a single download, and urgent
+    requests go before the others. callback is called with the MSN object,
+    or None if the download failed, and the set of handles still waiting
+    for it. Requests made without handle only fill the avatar cache."""
+
+    def __init__(self, connection, callback, max_fetches=MAX_AVATAR_FETCHES):
+        self._conn = weakref.proxy(connection)
+        self._callback = callback
+        self._max_fetches = max_fetches
+
+        self._urgent = deque()
+        self._queue = deque()
+        self._queued = {} # token -> (msn_object, contact)
+        self._fetching = {} # token -> timeout source
+        self._waiters = {} # token -> set of handles
+        self._handle_tokens = {} # handle -> token
+
+    def request(self, handle, contact, urgent=False):
+        msn_object = contact.msn_object
+        token = msn_object._data_sha.encode("hex")
+
+        if handle is not None:
+            if self._handle_tokens.get(handle) not in (None, token):
+                self.cancel(handle)
+            self._handle_tokens[handle] = token
+            self._waiters.setdefault(token, set()).add(handle)
+
+        if token in self._fetching:
+            return
+        if token not in self._queued:
+            self._queued[token] = (msn_object, contact)
+        elif not urgent or token in self._urgent:
+            return
+        if urgent:
+            self._urgent.append(token)
+        else:
+            self._queue.append(token)
+        self._fetch_next()
+
+    def cancel(self, handle):
+        """Stop waiting for the avatar this handle requested, typically
+        because its token changed."""
+        token = self._handle_tokens.pop(handle, None)
+        if token is None:
+            return
+        waiters = self._waiters.get(token)
+        if waiters is not None:
+            waiters.discard(handle)
+            if not waiters:
+                del self._waiters[token]
+                # Nobody wants it anymore, tokens left in the queues are
+                # skipped. A download in progress is kept: it will end up
+                # in the cache.
+                self._queued.pop(token, None)
+
+    def idle(self):
+        """Whether a new request would be started straight away."""
+        return len(self._fetching) < self._max_fetches and \
+                not self._urgent and not self._queue
+
+    def clear(self):
+        for source in self._fetching.values():
+            gobject.source_remove(source)
+        self._fetching.clear()
+        self._urgent.clear()
+        self._queue.clear()
+        self._queued.clear()
+        self._waiters.clear()
+        self._handle_tokens.clear()
+
+    def _fetch_next(self):
+        while len(self._fetching) < self._max_fetches:
+            if self._urgent:
+                token = self._urgent.popleft()
+            elif self._queue:
+                token = self._queue.popleft()
+            else:
+                return
+            if token not in self._queued or token in self._fetching:
+                continue # cancelled, or queued again as urgent
+
+            msn_object, contact = self._queued.pop(token)
+            self._fetching[token] = gobject.timeout_add_seconds(
+                    AVATAR_FETCH_TIMEOUT, self._fetch_timed_out, token)
+            logger.debug("Fetching avatar %s (%d more queued)" %
+                    (token, len(self._queued)))
+            self._conn.msn_client.msn_object_store.request(msn_object,
+                    (self._fetched, token), peer=contact)
+
+    def _fetched(self, msn_object, token):
+        source = self._fetching.pop(token, None)
+        if source is None:
+            return # timed out or cleared
+        gobject.source_remove(source)
+        self._done(token, msn_object)
+
+    def _fetch_timed_out(self, token):
+        logger.warning("Fetching avatar %s timed out" % token)
+        del self._fetching[token]
+        self._done(token, None)
+        return False
+
+    def _done(self, token, msn_object):
+        handles = self._waiters.pop(token, set())
+        for handle in handles:
+            if self._handle_tokens.get(handle) == token:
+                del self._handle_tokens[handle]
+        self._callback(msn_object, handles)
+        self._fetch_next()
@@ -16,17 +16,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import array
 import logging
 import imghdr
 import hashlib
 import dbus
+import gobject
 
 import telepathy
 import papyon
 import papyon.event
 import papyon.util.string_io as StringIO
 
-from butterfly.util.decorator import async
+from butterfly.avatar_cache import ButterflyAvatarCache
+from butterfly.avatar_fetcher import ButterflyAvatarFetcher
+from butterfly.util.worker import WorkerPool
 
 __all__ = ['ButterflyAvatars']
 
@@ -39,6 +43,86 @@ RECOMMENDED_AVATAR_PIXELS = dbus.UInt32(96)
 MAXIMUM_AVATAR_PIXELS = dbus.UInt32(192)
 MAXIMUM_AVATAR_BYTES = dbus.UInt32(500 * 1024)
 
+# Bytes of an image imghdr needs to recognize its type
+AVATAR_HEADER_BYTES = 32
+
+# Seconds to wait after connecting before prefetching avatars, and again
+# while the initial presences are still being signalled
+AVATAR_PREFETCH_DELAY = 10
+
+# Milliseconds between two prefetched avatars
+AVATAR_PREFETCH_INTERVAL = 500
+
+# Number of downscaled avatars remembered by the hash of the original
+DOWNSCALED_AVATARS_CACHE_SIZE = 8
+
+# Shared by all the connections, avatars are hashed and sniffed there
+_workers = WorkerPool()
+
+
+def inspect_avatar(avatar, data_sha, mime_type=None):
+    """Return the MIME type of the avatar, sniffing it unless it is already
+    known, and whether its data matches the SHA1 data_sha. This is run in
+    a worker thread."""
+    if mime_type is None:
+        type = imghdr.what('', avatar[:AVATAR_HEADER_BYTES])
+        if type is None: type = 'jpeg'
+        mime_type = 'image/' + type
+    return mime_type, hashlib.sha1(avatar).digest() == data_sha
+
+def downscale_avatar(avatar):
+    """Return the avatar re-encoded to fit in RECOMMENDED_AVATAR_PIXELS, or
+    None if it is small enough already or can't be downscaled."""
+    try:
+        from PIL import Image
+    except ImportError:
+        try:
+            import Image
+        except ImportError:
+            logger.warning("Please install the Python Imaging Library to "
+                    "enable avatar downscaling.")
+            return None
+
+    try:
+        image = Image.open(StringIO.StringIO(avatar))
+        format = image.format
+        if format not in ('PNG', 'JPEG', 'GIF') or \
+                max(image.size) <= RECOMMENDED_AVATAR_PIXELS:
+            return None
+
+        if format == 'GIF':
+            # Don't lose the animation of animated GIFs
+            try:
+                image.seek(1)
+            except EOFError:
+                image.seek(0)
+            else:
+                return None
+
+        if format == 'PNG':
+            image = image.convert('RGBA')
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        size = int(RECOMMENDED_AVATAR_PIXELS)
+        image.thumbnail((size, size), Image.ANTIALIAS)
+        if format == 'GIF':
+            image = image.convert('P', palette=Image.ADAPTIVE)
+
+        output = StringIO.StringIO()
+        if format == 'JPEG':
+            image.save(output, format, quality=90)
+        else:
+            image.save(output, format)
+        downscaled = output.getvalue()
+    except Exception, e:
+        logger.warning("Failed to downscale avatar: %s" % e)
+        return None
+
+    if len(downscaled) >= len(avatar):
+        return None
+    return downscaled
+
+
 class ButterflyAvatars(\
         telepathy.server.ConnectionInterfaceAvatars,
         papyon.event.ContactEventInterface,
@@ -46,6 +130,15 @@ class ButterflyAvatars(\
 
     def __init__(self):
         self._avatar_known = False
+        self._avatar_cache = ButterflyAvatarCache()
+        self._avatar_mime_types = {} # token -> MIME type
+        self._prefetch_source = None
+        self._prefetch_contacts = []
+        # SHA1 of an avatar set by a client -> (avatar to upload, its SHA1),
+        # None if it is uploaded as it is
+        self._downscaled_avatars = {}
+        self._avatar_fetcher = ButterflyAvatarFetcher(self,
+                self._msn_object_retrieved)
         telepathy.server.ConnectionInterfaceAvatars.__init__(self)
         papyon.event.ContactEventInterface.__init__(self, self.msn_client)
         papyon.event.ProfileEventInterface.__init__(self, self.msn_client)
@@ -73,49 +166,114 @@ class ButterflyAvatars(\
         result = {}
         for handle_id in contacts:
             handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, handle_id)
-            contact = handle.contact
+            token = self._get_contact_attribute(handle,
+                    telepathy.CONNECTION_INTERFACE_AVATARS)
+            if token is not None:
+                result[handle] = token
+        return result
 
-            if contact is not None:
-                msn_object = contact.msn_object
-            else:
-                msn_object = None
+    def _get_avatar_token(self, handle):
+        """Get the avatar token of one handle, None if it isn't known"""
+        contact = handle.contact
 
-            if msn_object is not None:
-                result[handle] = msn_object._data_sha.encode("hex")
-            elif self._avatar_known:
-                result[handle] = ""
-        return result
+        if contact is not None:
+            msn_object = contact.msn_object
+        else:
+            msn_object = None
+
+        if msn_object is not None:
+            return msn_object._data_sha.encode("hex")
+        elif self._avatar_known:
+            return ""
+        return None
 
     def RequestAvatars(self, contacts):
+        channel_handles = None
         for handle_id in contacts:
             handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, handle_id)
             if handle == self._self_handle:
                 contact = self.msn_client.profile
             else:
                 contact = handle.contact
-            if contact is not None:
-                msn_object = contact.msn_object
-                self.msn_client.msn_object_store.request(msn_object,
-                        (self._msn_object_retrieved, handle), peer=contact)
+            if contact is None or contact.msn_object is None:
+                continue
+
+            msn_object = contact.msn_object
+            token = msn_object._data_sha.encode("hex")
+            cached = self._avatar_cache.get(token)
+            if cached is not None:
+                logger.info("Avatar %s found in cache" % token)
+                avatar, mime_type = cached
+                self.AvatarRetrieved(handle, token, dbus.ByteArray(avatar),
+                        mime_type)
+                continue
+
+            # The contacts we are talking to go first
+            if channel_handles is None:
+                channel_handles = \
+                        self._channel_manager.contact_channel_handles()
+            self._avatar_fetcher.request(handle, contact,
+                    handle in channel_handles)
 
+    # Overwrite the dbus attribute to get the avatar as a string
+    @dbus.service.method(telepathy.CONNECTION_INTERFACE_AVATARS,
+            in_signature='ays', out_signature='s', byte_arrays=True)
     def SetAvatar(self, avatar, mime_type):
-        self._avatar_known = True
+        self._set_avatar_known()
         if not isinstance(avatar, str):
-            avatar = "".join([chr(b) for b in avatar])
+            avatar = array.array('B', avatar).tostring()
+
+        data_sha = hashlib.sha1(avatar).digest()
+        if self._downscale_avatars:
+            avatar, data_sha = self._downscaled_avatar(avatar, data_sha)
+        avatar_token = data_sha.encode("hex")
+
+        current = self.msn_client.profile.msn_object
+        if current is not None and current._data_sha == data_sha:
+            logger.info("Self avatar already set to %s" % avatar_token)
+            return avatar_token
+
         msn_object = papyon.p2p.MSNObject(self.msn_client.profile,
                          len(avatar),
                          papyon.p2p.MSNObjectType.DISPLAY_PICTURE,
-                         hashlib.sha1(avatar).hexdigest() + '.tmp',
+                         avatar_token + '.tmp',
                          "",
+                         shad=data_sha,
                          data=StringIO.StringIO(avatar))
         self.msn_client.profile.msn_object = msn_object
-        avatar_token = msn_object._data_sha.encode("hex")
         logger.info("Setting self avatar to %s" % avatar_token)
         return avatar_token
 
+    def _downscaled_avatar(self, avatar, data_sha):
+        """Return the avatar to upload instead of this one, and its SHA1."""
+        if data_sha in self._downscaled_avatars:
+            downscaled = self._downscaled_avatars[data_sha]
+        else:
+            data = downscale_avatar(avatar)
+            if data is None:
+                downscaled = None # upload it as it is
+            else:
+                logger.info("Downscaled avatar from %d to %d bytes" %
+                        (len(avatar), len(data)))
+                downscaled = (data, hashlib.sha1(data).digest())
+            if len(self._downscaled_avatars) >= DOWNSCALED_AVATARS_CACHE_SIZE:
+                self._downscaled_avatars.clear()
+            self._downscaled_avatars[data_sha] = downscaled
+
+        if downscaled is None:
+            return avatar, data_sha
+        return downscaled
+
     def ClearAvatar(self):
         self.msn_client.profile.msn_object = None
-        self._avatar_known = True
+        self._set_avatar_known()
+
+    def _set_avatar_known(self):
+        if not self._avatar_known:
+            self._avatar_known = True
+            # Contacts without avatar now have an empty token
+            self._invalidate_all_contact_attributes(
+                    telepathy.CONNECTION_INTERFACE_AVATARS)
 
     # papyon.event.ContactEventInterface
     def on_contact_msn_object_changed(self, contact):
@@ -124,28 +282,106 @@ class ButterflyAvatars(\
         else:
             avatar_token = ""
         handle = self.ensure_contact_handle(contact)
-        self.AvatarUpdated(handle, avatar_token)
+        self._avatar_fetcher.cancel(handle)
+        self._invalidate_contact_attributes(handle,
+                telepathy.CONNECTION_INTERFACE_AVATARS)
+        self._contact_attribute_changed(handle,
+                telepathy.CONNECTION_INTERFACE_AVATARS, avatar_token)
 
     # papyon.event.ProfileEventInterface
     def on_profile_msn_object_changed(self):
+        self._invalidate_contact_attributes(self._self_handle,
+                telepathy.CONNECTION_INTERFACE_AVATARS)
         msn_object = self.msn_client.profile.msn_object
         if msn_object is not None:
             avatar_token = msn_object._data_sha.encode("hex")
             logger.info("Self avatar changed to %s" % avatar_token)
-            handle = self._self_handle
+            self._contact_attribute_changed(self._self_handle,
+                    telepathy.CONNECTION_INTERFACE_AVATARS, avatar_token)
+
+    def _schedule_avatar_prefetch(self):
+        self._stop_avatar_prefetch()
+        self._prefetch_source = gobject.timeout_add_seconds(
+                AVATAR_PREFETCH_DELAY, self._start_avatar_prefetch)
+
+    def _stop_avatar_prefetch(self):
+        if self._prefetch_source is not None:
+            gobject.source_remove(self._prefetch_source)
+            self._prefetch_source = None
+        self._prefetch_contacts = []
+
+    def _start_avatar_prefetch(self):
+        # Let the login presence burst settle first
+        if len(self._presence_aggregator) > 0:
+            return True
+
+        channel_handles = self._channel_manager.contact_channel_handles()
+        talking = []
+        others = []
+        for contact in self.msn_client.address_book.contacts:
+            if contact.is_member(papyon.Membership.FORWARD):
+                if self._find_contact_handle(contact) in channel_handles:
+                    talking.append(contact)
+                else:
+                    others.append(contact)
+        # Popped from the end, the contacts we are talking to go first
+        self._prefetch_contacts = others[::-1] + talking[::-1]
+        logger.info("Prefetching the avatars of up to %d contacts" %
+                len(self._prefetch_contacts))
+
+        self._prefetch_source = gobject.timeout_add(AVATAR_PREFETCH_INTERVAL,
+                self._prefetch_next_avatar)
+        return False
+
+    def _prefetch_next_avatar(self):
+        # Avatars requested by clients go first
+        if not self._avatar_fetcher.idle():
+            return True
+
+        while self._prefetch_contacts:
+            contact = self._prefetch_contacts.pop()
+            msn_object = contact.msn_object
+            if msn_object is None or \
+                    contact.presence == papyon.Presence.OFFLINE:
+                continue
+            if msn_object._data_sha.encode("hex") in self._avatar_cache:
+                continue
+            self._avatar_fetcher.request(None, contact)
+            return True
+
+        logger.info("Done prefetching avatars")
+        self._prefetch_source = None
+        return False
+
+    def _signal_avatars_updated(self, tokens):
+        for handle, avatar_token in tokens.iteritems():
             self.AvatarUpdated(handle, avatar_token)
 
-    @async
-    def _msn_object_retrieved(self, msn_object, handle):
-        if msn_object is not None and msn_object._data is not None:
-            logger.info("Avatar retrieved %s" % msn_object._data_sha.encode("hex"))
-            msn_object._data.seek(0, 0)
-            avatar = msn_object._data.read()
-            msn_object._data.seek(0, 0)
-            type = imghdr.what('', avatar)
-            if type is None: type = 'jpeg'
-            avatar = dbus.ByteArray(avatar)
-            token = msn_object._data_sha.encode("hex")
-            self.AvatarRetrieved(handle, token, avatar, 'image/' + type)
-        else:
+    def _msn_object_retrieved(self, msn_object, handles):
+        if msn_object is None or msn_object._data is None:
             logger.info("Avatar retrieved but NULL")
+            return
+
+        token = msn_object._data_sha.encode("hex")
+        logger.info("Avatar retrieved %s" % token)
+        msn_object._data.seek(0, 0)
+        avatar = msn_object._data.read()
+        # papyon keeps the MSN objects of our contacts around, don't let
+        # them keep the images too. Ours must stay to be sent to them.
+        if msn_object is not self.msn_client.profile.msn_object:
+            msn_object._data = None
+        else:
+            msn_object._data.seek(0, 0)
+
+        _workers.run(inspect_avatar,
+                (avatar, msn_object._data_sha, self._avatar_mime_types.get(token)),
+                lambda result: self._avatar_inspected(token, handles, avatar,
+                    *result))
+
+    def _avatar_inspected(self, token, handles, avatar, mime_type, valid):
+        self._avatar_mime_types[token] = mime_type
+        if valid:
+            self._avatar_cache.put(token, avatar, mime_type)
+        avatar = dbus.ByteArray(avatar)
+        for handle in handles:
+            self.AvatarRetrieved(handle, token, avatar, mime_type)
@@ -23,7 +23,7 @@ import telepathy
 import papyon
 import papyon.event
 
-from butterfly.util.decorator import async
+from butterfly.util.decorator import time_sliced
 
 __all__ = ['ButterflyCapabilities']
 
@@ -74,6 +74,12 @@ class ButterflyCapabilities(
           telepathy.CHANNEL_TYPE_FILE_TRANSFER + '.ContentType'])
 
 
+    # (supports_sip_invite, has_webcam) -> result of _get_capabilities and
+    # _get_contact_capabilities, shared by all the contacts with these
+    # client capabilities
+    _capabilities_by_client = {}
+    _contact_capabilities_by_client = {}
+
     def __init__(self):
         telepathy.server.ConnectionInterfaceCapabilities.__init__(self)
         telepathy.server.ConnectionInterfaceContactCapabilities.__init__(self)
@@ -81,6 +87,7 @@ class ButterflyCapabilities(
 
         self._video_clients = []
         self._update_capabilities_calls = []
+        self._capabilities_job = None
 
 
     ### Events handling ------------------------------------------------------
@@ -90,7 +97,8 @@ class ButterflyCapabilities(
         handle = self.ensure_contact_handle(contact)
         if handle == self._self_handle:
             return # don't update our own capabilities using server ones
-        self._update_capabilities(handle)
+        if self._legacy_interfaces:
+            self._update_capabilities(handle)
         self._update_contact_capabilities([handle])
 
     # papyon.event.AddressBookEventInterface
@@ -99,42 +107,69 @@ class ButterflyCapabilities(
         default capabilities to the contact"""
         if contact.is_member(papyon.Membership.FORWARD):
             handle = self.ensure_contact_handle(contact)
-            self._add_default_capabilities([handle])
+            if self._legacy_interfaces:
+                self._add_default_capabilities([handle])
             self._update_contact_capabilities([handle])
 
 
     ### Capabilities interface -----------------------------------------------
 
+    def _client_key(self, contact):
+        caps = contact.client_capabilities
+        return (bool(caps.supports_sip_invite), bool(caps.has_webcam))
+
     def _get_capabilities(self, contact):
+        key = self._client_key(contact)
+        result = self._capabilities_by_client.get(key)
+        if result is not None:
+            return result
+
         gen_caps = 0
         spec_caps = 0
-        caps = contact.client_capabilities
+        supports_sip_invite, has_webcam = key
 
-        if caps.supports_sip_invite:
+        if supports_sip_invite:
             gen_caps |= telepathy.CONNECTION_CAPABILITY_FLAG_CREATE
             gen_caps |= telepathy.CONNECTION_CAPABILITY_FLAG_INVITE
             spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_AUDIO
             spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_NAT_TRAVERSAL_STUN
-            if caps.has_webcam:
+            if has_webcam:
                 spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_VIDEO
 
-        return gen_caps, spec_caps
+        result = self._capabilities_by_client[key] = (gen_caps, spec_caps)
+        return result
+
+    def _get_handle_capabilities(self, handle):
+        """Get the Capabilities of one handle, as returned by
+        GetCapabilities"""
+        caps = self._caps.get(handle, {})
+        return dbus.Array([(int(handle), ctype, gen, spec)
+            for ctype, (gen, spec) in caps.items()], signature='(usuu)')
 
     def _add_default_capabilities(self, handles):
         """Add the default capabilities to these contacts."""
         ret = []
         for handle in handles:
-            new_flag = telepathy.CONNECTION_CAPABILITY_FLAG_CREATE
+            ret.extend(self._diff_default_capabilities(handle))
+        self.CapabilitiesChanged(ret)
+
+    def _diff_default_capabilities(self, handle):
+        """Add the default capabilities to this contact and return the
+        changes to signal with CapabilitiesChanged."""
+        self._invalidate_contact_attributes(handle,
+                telepathy.CONNECTION_INTERFACE_CAPABILITIES)
+        new_flag = telepathy.CONNECTION_CAPABILITY_FLAG_CREATE
+        ret = []
 
-            ctype = telepathy.CHANNEL_TYPE_TEXT
-            diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
-            ret.append(diff)
+        ctype = telepathy.CHANNEL_TYPE_TEXT
+        diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
+        ret.append(diff)
 
-            ctype = telepathy.CHANNEL_TYPE_FILE_TRANSFER
-            diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
-            ret.append(diff)
+        ctype = telepathy.CHANNEL_TYPE_FILE_TRANSFER
+        diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
+        ret.append(diff)
 
-        self.CapabilitiesChanged(ret)
+        return ret
 
     def _update_capabilities(self, handle):
         ctype = telepathy.CHANNEL_TYPE_STREAMED_MEDIA
@@ -142,6 +177,8 @@ class ButterflyCapabilities(
         new_gen, new_spec = self._get_capabilities(handle.contact)
         diff = self._diff_capabilities(handle, ctype, new_gen, new_spec)
         if diff is not None:
+            self._invalidate_contact_attributes(handle,
+                    telepathy.CONNECTION_INTERFACE_CAPABILITIES)
             self.CapabilitiesChanged([diff])
 
 
@@ -157,6 +194,8 @@ class ButterflyCapabilities(
             if caps == telepathy.CHANNEL_TYPE_STREAMED_MEDIA:
                 self._msn_client.profile.client_id.has_webcam = False
 
+        self._invalidate_contact_attributes(self._self_handle,
+                telepathy.CONNECTION_INTERFACE_CAPABILITIES)
         return telepathy.server.ConnectionInterfaceCapabilities.\
             AdvertiseCapabilities(self, add, remove)
 
@@ -198,46 +237,95 @@ class ButterflyCapabilities(
 
         # Signal.
         if changed:
-            updated = dbus.Dictionary({self._self_handle: self._contact_caps[self._self_handle]},
-                signature='ua(a{sv}as)')
-            self.ContactCapabilitiesChanged(updated)
+            self._contact_attribute_changed(self._self_handle,
+                    telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES)
 
     def _get_contact_capabilities(self, contact):
-        contact_caps = []
-        caps = contact.client_capabilities
-
-        contact_caps.append(self.text_chat_class)
-        contact_caps.append(self.file_transfer_class)
-        if caps.supports_sip_invite:
-            if caps.has_webcam:
+        """Return the requestable channel classes of a contact, as a tuple
+        shared with the other contacts using the same client."""
+        key = self._client_key(contact)
+        contact_caps = self._contact_capabilities_by_client.get(key)
+        if contact_caps is not None:
+            return contact_caps
+
+        contact_caps = [self.text_chat_class, self.file_transfer_class]
+        supports_sip_invite, has_webcam = key
+        if supports_sip_invite:
+            if has_webcam:
                 contact_caps.append(self.av_chat_class)
             else:
                 contact_caps.append(self.audio_chat_class)
 
+        contact_caps = tuple(contact_caps)
+        self._contact_capabilities_by_client[key] = contact_caps
         return contact_caps
 
+    def _get_handle_contact_capabilities(self, handle):
+        """Get the ContactCapabilities of one handle, as returned by
+        GetContactCapabilities"""
+        return dbus.Array(self._contact_caps.get(handle, []),
+                signature='(a{sv}as)')
+
     def _update_contact_capabilities(self, handles):
-        caps = {}
         for handle in handles:
-            caps[handle] = self._get_contact_capabilities(handle.contact)
-            self._contact_caps[handle] = caps[handle] # update global dict
-        ret = dbus.Dictionary(caps, signature='ua(a{sv}as)')
-        self.ContactCapabilitiesChanged(ret)
+            self._update_handle_contact_capabilities(handle)
+
+    def _update_handle_contact_capabilities(self, handle):
+        self._contact_caps[handle] = \
+                self._get_contact_capabilities(handle.contact)
+        self._invalidate_contact_attributes(handle,
+                telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES)
+        self._contact_attribute_changed(handle,
+                telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES)
+
+    def _signal_contact_capabilities_changed(self, handles):
+        caps = dbus.Dictionary(signature='ua(a{sv}as)')
+        for handle in handles:
+            caps[handle] = self._contact_caps.get(handle, [])
+        self.ContactCapabilitiesChanged(caps)
 
 
     ### Initialization -------------------------------------------------------
 
-    @async
+    def _start_populating_capabilities(self):
+        self._stop_populating_capabilities()
+        self._capabilities_job = self._populate_capabilities()
+
+    def _stop_populating_capabilities(self):
+        if self._capabilities_job is not None:
+            self._capabilities_job.cancel()
+            self._capabilities_job = None
+
+    @time_sliced()
     def _populate_capabilities(self):
         """ Add the default capabilities to all contacts in our
         contacts list."""
-        handles = set([self._self_handle])
-        for contact in self.msn_client.address_book.contacts:
+        handles = set()
+        diffs = []
+
+        def add_capabilities(handle):
+            if handle in handles:
+                return
+            handles.add(handle)
+            if self._legacy_interfaces:
+                diffs.extend(self._diff_default_capabilities(handle))
+            self._update_handle_contact_capabilities(handle)
+
+        add_capabilities(self._self_handle)
+        roster = self._roster_handles
+        # The address book may change while we are suspended
+        contacts = list(self.msn_client.address_book.contacts)
+        for contact in contacts:
+            yield
             if contact.is_member(papyon.Membership.FORWARD):
-                handle = self.ensure_contact_handle(contact)
-                handles.add(handle)
-        self._add_default_capabilities(handles)
-        self._update_contact_capabilities(handles)
+                handle = roster.get(contact)
+                if handle is None:
+                    handle = self.ensure_contact_handle(contact)
+                add_capabilities(handle)
+        # We are done synchronizing, don't keep the roster alive
+        self._roster_handles = {}
+        if self._legacy_interfaces:
+            self.CapabilitiesChanged(diffs)
 
         # These caps were updated before we were online.
         for caps in self._update_capabilities_calls:
@@ -23,7 +23,7 @@ import telepathy
 import papyon
 import papyon.event
 
-from butterfly.util.decorator import async
+from butterfly.util.decorator import time_sliced
 from butterfly.channel import ButterflyChannel
 
 __all__ = ['ButterflyContactListChannelFactory']
@@ -128,7 +128,14 @@ class ButterflyListChannel(
         ButterflyChannel.__init__(self, connection, props)
         telepathy.server.ChannelInterfaceGroup.__init__(self)
         papyon.event.AddressBookEventInterface.__init__(self, connection.msn_client)
-        self._populate(connection)
+        self._populate_job = self._populate(connection)
+
+    def Close(self):
+        self.stop_populating()
+        telepathy.server.ChannelTypeContactList.Close(self)
+
+    def stop_populating(self):
+        self._populate_job.cancel()
 
     def GetLocalPendingMembersWithInfo(self):
         return []
@@ -165,19 +172,32 @@ class ButterflyListChannel(
     def on_addressbook_contact_unblocked(self, contact):
         pass
 
-    @async
+    @time_sliced()
     def _populate(self, connection):
+        members = []
+
+        roster = connection._roster_handles
+        # The address book may change while we are suspended
+        contacts = list(connection.msn_client.address_book.contacts)
+        for contact in contacts:
+            yield
+            ad, lp, rp = self._filter_contact(contact)
+            if ad or lp or rp:
+                handle = roster.get(contact)
+                if handle is None:
+                    handle = self._conn.ensure_contact_handle(contact)
+                members.append((contact, handle))
+
+        # Filter the contacts again, the events of the ones which changed
+        # while we were suspended were ignored or would be overridden
         added = set()
         local_pending = set()
         remote_pending = set()
-
-        for contact in connection.msn_client.address_book.contacts:
+        for contact, handle in members:
             ad, lp, rp = self._filter_contact(contact)
-            if ad or lp or rp:
-                handle = self._conn.ensure_contact_handle(contact)
-                if ad: added.add(handle)
-                if lp: local_pending.add(handle)
-                if rp: remote_pending.add(handle)
+            if ad: added.add(handle)
+            if lp: local_pending.add(handle)
+            if rp: remote_pending.add(handle)
         self.MembersChanged('', added, (), local_pending, remote_pending, 0,
                 telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
 
@@ -228,8 +248,7 @@ class ButterflySubscribeListChannel(ButterflyListChannel,
 
         account = handle.account
         network = handle.network
-        groups = list(handle.pending_groups)
-        handle.pending_groups = set()
+        groups = handle.pop_pending_groups()
         ab = self._conn.msn_client.address_book
 
         # We redefine these two callbacks for two reasons:
@@ -304,11 +323,10 @@ class ButterflySubscribeListChannel(ButterflyListChannel,
         if contact.is_member(papyon.Membership.FORWARD):
             self.MembersChanged('', [handle], (), (), (), 0,
                     telepathy.CHANNEL_GROUP_CHANGE_REASON_INVITED)
-            if len(handle.pending_groups) > 0:
+            if handle.pending_groups:
                 ab = self._conn.msn_client.address_book
-                for group in handle.pending_groups:
+                for group in handle.pop_pending_groups():
                     ab.add_contact_to_group(group, contact)
-                handle.pending_groups = set()
 
 
 class ButterflyPublishListChannel(ButterflyListChannel,
@@ -65,17 +65,17 @@ class ButterflyGroupChannel(ButterflyListChannel,
                     self.__pending_add.append(contact_handle_id)
             return
         else:
+            group = self._handle.group
             for contact_handle_id in contacts:
                 contact_handle = self._conn.handle(telepathy.HANDLE_TYPE_CONTACT,
                             contact_handle_id)
                 logger.info("Adding contact %s to group %s" %
                         (unicode(contact_handle), unicode(self._handle)))
                 contact = contact_handle.contact
-                group = self._handle.group
                 if contact is not None and contact.is_member(papyon.Membership.FORWARD):
                     ab.add_contact_to_group(group, contact)
                 else:
-                    contact_handle.pending_groups.add(group)
+                    contact_handle.add_pending_group(group)
 
     def RemoveMembers(self, contacts, message):
         ab = self._conn.msn_client.address_book
@@ -91,17 +91,17 @@ class ButterflyGroupChannel(ButterflyListChannel,
                     self.__pending_remove.append(contact_handle_id)
             return
         else:
+            group = self._handle.group
             for contact_handle_id in contacts:
                 contact_handle = self._conn.handle(telepathy.HANDLE_TYPE_CONTACT,
                             contact_handle_id)
                 logger.info("Removing contact %s from pending group %s" %
                         (unicode(contact_handle), unicode(self._handle)))
                 contact = contact_handle.contact
-                group = self._handle.group
                 if contact is not None and contact.is_member(papyon.Membership.FORWARD):
                     ab.delete_contact_from_group(group, contact)
                 else:
-                    contact_handle.pending_groups.discard(group)
+                    contact_handle.discard_pending_group(group)
 
     def Close(self):
         logger.debug("Deleting group %s" % self._handle.name)
@@ -127,6 +127,7 @@ class ButterflyGroupChannel(ButterflyListChannel,
 
     def on_addressbook_group_deleted(self, group):
         if group.name.decode("utf-8") == self._handle.name:
+            self.stop_populating()
             self.Closed()
             self._conn.remove_channel(self)
 
@@ -249,6 +249,20 @@ class ButterflyTextChannel(
 
         return telepathy.server.ChannelTypeText.ListPendingMessages(self, clear)
 
+    def pending_message_senders(self):
+        """Return the IDs of the handles which sent the messages still
+        pending."""
+        senders = set()
+        for message in self._pending_messages2.itervalues():
+            sender = message[0].get('message-sender')
+            if sender is not None:
+                senders.add(int(sender))
+        # telepathy.server.ChannelTypeText keeps its own pending list
+        for timestamp, sender, type, flags, text in \
+                self._pending_messages.itervalues():
+            senders.add(int(sender))
+        return senders
+
     # Redefine GetSelfHandle since we use our own handle
     #  as Butterfly doesn't have channel specific handles
     def GetSelfHandle(self):
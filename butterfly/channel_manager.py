@@ -92,6 +92,39 @@ class ButterflyChannelManager(telepathy.server.ChannelManager):
         self.implement_channel_classes(telepathy.CHANNEL_TYPE_STREAMED_MEDIA, self._get_media_channel)
         self.implement_channel_classes(telepathy.CHANNEL_TYPE_FILE_TRANSFER, self._get_ft_channel)
 
+    def close(self):
+        # Contact lists are only removed from the bus, not closed, stop
+        # their population first
+        for handle_channels in \
+                self._channels[telepathy.CHANNEL_TYPE_CONTACT_LIST].values():
+            for channel in handle_channels:
+                channel.stop_populating()
+        telepathy.server.ChannelManager.close(self)
+
+    def forget_closed_channels(self):
+        """Drop the handles whose channels have all been closed, so they
+        don't keep them alive."""
+        for channels in self._channels.values():
+            for handle, handle_channels in channels.items():
+                if not handle_channels:
+                    del channels[handle]
+
+    def contact_channel_handles(self):
+        """Return the contact handles we have a text, media or file
+        transfer channel with, and the members of our conferences."""
+        handles = set()
+        for channel_type, channels in self._channels.items():
+            if channel_type == telepathy.CHANNEL_TYPE_CONTACT_LIST:
+                continue
+            for handle, handle_channels in channels.items():
+                if not handle_channels:
+                    continue
+                if handle.get_type() == telepathy.HANDLE_TYPE_CONTACT:
+                    handles.add(handle)
+                for channel in handle_channels:
+                    handles.update(getattr(channel, '_members', ()))
+        return handles
+
     def _get_list_channel(self, props):
         _, surpress_handler, handle = self._get_type_requested_handle(props)
 
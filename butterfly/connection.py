@@ -20,6 +20,7 @@
 import weakref
 import logging
 
+import gobject
 import dbus
 import telepathy
 import papyon
@@ -29,15 +30,23 @@ from butterfly.presence import ButterflyPresence
 from butterfly.aliasing import ButterflyAliasing
 from butterfly.avatars import ButterflyAvatars
 from butterfly.capabilities import ButterflyCapabilities
-from butterfly.handle import ButterflyHandleFactory, network_to_extension
+from butterfly.handle import ButterflyHandleFactory, network_to_extension, \
+        parse_contact_name
 from butterfly.contacts import ButterflyContacts
 from butterfly.channel_manager import ButterflyChannelManager
 from butterfly.mail_notification import ButterflyMailNotification
+from butterfly.publisher import ButterflyProfilePublisher
 
 __all__ = ['ButterflyConnection']
 
 logger = logging.getLogger('Butterfly.Connection')
 
+# Seconds between two sweeps of unused contact handles
+HANDLE_SWEEP_INTERVAL = 300
+
+# Number of contact IDs whose normalization is remembered
+NORMALIZED_NAMES_CACHE_SIZE = 4096
+
 
 class ButterflyConnection(telepathy.server.Connection,
         telepathy.server.ConnectionInterfaceRequests,
@@ -49,7 +58,8 @@ class ButterflyConnection(telepathy.server.Connection,
         ButterflyMailNotification,
         papyon.event.ClientEventInterface,
         papyon.event.InviteEventInterface,
-        papyon.event.OfflineMessagesEventInterface):
+        papyon.event.OfflineMessagesEventInterface,
+        papyon.event.AddressBookEventInterface):
 
 
     def __init__(self, protocol, manager, parameters):
@@ -78,8 +88,45 @@ class ButterflyConnection(telepathy.server.Connection,
             self._fill_suggested_proxies()
             self._use_next_proxy()
 
+            # Contact handle identity maps: papyon contact -> handle weakref
+            # and (account, network) -> handle, plus the (account, network)
+            # keys the address book is known not to contain.
+            self._contact_handles = weakref.WeakKeyDictionary()
+            self._account_handles = weakref.WeakValueDictionary()
+            self._unknown_contacts = set()
+
+            # Case-folded group name -> papyon group
+            self._groups_by_name = {}
+
+            # Unused contact handles found by the last sweep, they get
+            # released if they are still unused at the next one
+            self._sweep_source = None
+            self._sweep_candidates = set()
+            self._handles_swept = 0
+
+            # contact -> handle for the whole roster while synchronizing
+            self._roster_handles = {}
+
+            # Contact handles clients asked for by ID, as handle -> True
+            self._requested_handles = weakref.WeakKeyDictionary()
+
+            # contact ID -> (handle name, (account, network)), or None if
+            # the ID isn't valid
+            self._normalized_names = {}
+
+            # Whether to implement the Presence and Capabilities interfaces
+            # superseded by SimplePresence and ContactCapabilities
+            self._legacy_interfaces = parameters['legacy-interfaces']
+
+            # Whether to shrink our avatar to the recommended size
+            self._downscale_avatars = parameters['downscale-avatars']
+
+            # Whether to download the avatars of our contacts in advance
+            self._prefetch_avatars = parameters['prefetch-avatars']
+
             self._manager = weakref.proxy(manager)
             self._new_client(use_http=self._try_http)
+            self._profile_publisher = ButterflyProfilePublisher(self)
             self._account = (parameters['account'].encode('utf-8'),
                     parameters['password'].encode('utf-8'))
             self._channel_manager = ButterflyChannelManager(self, protocol)
@@ -95,6 +142,11 @@ class ButterflyConnection(telepathy.server.Connection,
             ButterflyContacts.__init__(self)
             ButterflyMailNotification.__init__(self)
 
+            if not self._legacy_interfaces:
+                self._interfaces.discard(telepathy.CONNECTION_INTERFACE_PRESENCE)
+                self._interfaces.discard(
+                        telepathy.CONNECTION_INTERFACE_CAPABILITIES)
+
             self_handle = self.create_handle(telepathy.HANDLE_TYPE_CONTACT,
                     self._account[0])
             self.set_self_handle(self_handle)
@@ -127,6 +179,9 @@ class ButterflyConnection(telepathy.server.Connection,
         papyon.event.ClientEventInterface.__init__(self, self._msn_client)
         papyon.event.InviteEventInterface.__init__(self, self._msn_client)
         papyon.event.OfflineMessagesEventInterface.__init__(self, self._msn_client)
+        papyon.event.AddressBookEventInterface.__init__(self, self._msn_client)
+        self._unknown_contacts.clear()
+        self._groups_by_name.clear()
 
     def _fill_suggested_proxies(self):
         try:
@@ -228,15 +283,191 @@ class ButterflyConnection(telepathy.server.Connection,
 
     def create_handle(self, handle_type, handle_name, **kwargs):
         """Create new handle with given type and name."""
-        handle_id = self.get_handle_id()
+        handle = self._add_handle(handle_type, self.get_handle_id(),
+                handle_name, **kwargs)
+        logger.info("New Handle %s" % unicode(handle))
+        return handle
+
+    def _add_handle(self, handle_type, handle_id, handle_name, **kwargs):
         handle = ButterflyHandleFactory(self, handle_type, handle_id,
                 handle_name, **kwargs)
         if handle is None:
             raise telepathy.NotAvailable('Handle type unsupported %d' % handle_type)
-        logger.info("New Handle %s" % unicode(handle))
         self._handles[handle_type, handle_id] = handle
+        if handle_type == telepathy.HANDLE_TYPE_CONTACT:
+            self._account_handles[handle.account, handle.network] = handle
+            if handle._contact is not None:
+                self._contact_handles[handle._contact] = weakref.ref(handle)
         return handle
 
+    def ensure_handle(self, handle_type, handle_name, **kwargs):
+        """Ensure handle with given type and name, looking contacts up in
+        the identity map instead of walking every known handle."""
+        if handle_type != telepathy.HANDLE_TYPE_CONTACT:
+            return telepathy.server.Connection.ensure_handle(self,
+                    handle_type, handle_name, **kwargs)
+        normalized = self._normalize_contact_name(handle_name)
+        if normalized is None:
+            raise telepathy.InvalidHandle('TargetID %s not valid for type %d' %
+                (handle_name, handle_type))
+        handle_name, (account, network) = normalized
+        handle = self._account_handles.get((account, network))
+        if handle is None:
+            if 'contact' not in kwargs:
+                kwargs.update(account=account, network=network)
+            handle = self.create_handle(handle_type, handle_name, **kwargs)
+        return handle
+
+    def ensure_contact_handles_by_name(self, names):
+        """Ensure contact handles for many contact IDs at once, without
+        logging each new handle. Return the list of handles, with None in
+        place of invalid IDs, and the list of invalid IDs."""
+        handles = []
+        invalid = []
+        missing = []
+        for name in names:
+            normalized = self._normalize_contact_name(name)
+            if normalized is None:
+                invalid.append(name)
+                handles.append(None)
+                continue
+            handle = self._account_handles.get(normalized[1])
+            if handle is None:
+                missing.append((len(handles), normalized))
+            handles.append(handle)
+
+        handle_type = telepathy.HANDLE_TYPE_CONTACT
+        handle_id = self._allocate_handle_ids(len(missing))
+        for index, (handle_name, (account, network)) in missing:
+            # The same ID can appear more than once
+            handle = self._account_handles.get((account, network))
+            if handle is None:
+                handle = self._add_handle(handle_type, handle_id, handle_name,
+                        account=account, network=network)
+                handle_id += 1
+            handles[index] = handle
+
+        if missing:
+            logger.info("New Handles for %d contact IDs" % len(missing))
+        return handles, invalid
+
+    def _normalize_contact_name(self, name):
+        """Return the normalized handle name and the (account, network)
+        pair of a contact ID, or None if it isn't valid."""
+        try:
+            return self._normalized_names[name]
+        except KeyError:
+            pass
+
+        if self.is_valid_handle_name(telepathy.HANDLE_TYPE_CONTACT, name):
+            handle_name = name.lower().strip()
+            normalized = (handle_name, parse_contact_name(handle_name))
+        else:
+            normalized = None
+
+        if len(self._normalized_names) >= NORMALIZED_NAMES_CACHE_SIZE:
+            self._normalized_names.clear()
+        self._normalized_names[name] = normalized
+        return normalized
+
+    def _allocate_handle_ids(self, count):
+        """Reserve count consecutive handle ids and return the first one."""
+        handle_id = self._next_handle_id
+        self._next_handle_id += count
+        return handle_id
+
+    def RequestHandles(self, handle_type, names, sender):
+        if handle_type != telepathy.HANDLE_TYPE_CONTACT:
+            return telepathy.server.Connection.RequestHandles(self,
+                    handle_type, names, sender)
+
+        self.check_connected()
+        handles, invalid = self.ensure_contact_handles_by_name(names)
+        if invalid:
+            raise telepathy.InvalidHandle('Invalid contact IDs: %s' %
+                    ', '.join(invalid))
+
+        for handle in handles:
+            self.add_client_handle(handle, sender)
+        self._requested_handles.update(dict.fromkeys(handles, True))
+        return [handle.get_id() for handle in handles]
+
+    def _referenced_handles(self):
+        """Return the set of contact handles which must not be released:
+        ourself, handles held by clients, handles used by channels or
+        having sent their pending messages and handles with pending
+        address book operations or which are in our address book."""
+        referenced = set([self._self_handle])
+
+        # telepathy.server.Connection keeps (type, handle) pairs per client
+        for held in self._client_handles.values():
+            for handle_type, handle in held:
+                referenced.add(handle)
+
+        for channel in self._channels:
+            for attribute in ('_handle', '_initiator'):
+                handle = getattr(channel, attribute, None)
+                if handle is not None:
+                    referenced.add(handle)
+            for attribute in ('_members', '_local_pending', '_remote_pending'):
+                referenced.update(getattr(channel, attribute, ()))
+            # Clients look the senders of pending messages up, even the
+            # ones which left the conversation
+            if hasattr(channel, 'pending_message_senders'):
+                for handle_id in channel.pending_message_senders():
+                    handle = self._handles.get(
+                            (telepathy.HANDLE_TYPE_CONTACT, handle_id))
+                    if handle is not None:
+                        referenced.add(handle)
+
+        for handle in self._handles.values():
+            if handle.get_type() != telepathy.HANDLE_TYPE_CONTACT:
+                continue
+            if handle.pending_alias is not None or handle.pending_groups:
+                referenced.add(handle)
+                continue
+            contact = handle.contact
+            if contact is not None and \
+                    contact.memberships != papyon.Membership.NONE:
+                referenced.add(handle)
+        return referenced
+
+    def _sweep_handles(self):
+        """Release the contact handles nobody used since the last sweep."""
+        referenced = self._referenced_handles()
+        self._channel_manager.forget_closed_channels()
+
+        unused = set()
+        for key, handle in self._handles.items():
+            if handle.get_type() == telepathy.HANDLE_TYPE_CONTACT and \
+                    handle not in referenced:
+                unused.add(key)
+
+        released = 0
+        for key in unused & self._sweep_candidates:
+            self._release_handle(self._handles[key])
+            released += 1
+        self._sweep_candidates = unused - self._sweep_candidates
+        self._handles_swept += released
+
+        if released > 0:
+            logger.info("Released %d unused contact handles (%d in total, "
+                    "%d left)" % (released, self._handles_swept,
+                    len(self._handles)))
+        return True
+
+    def _release_handle(self, handle):
+        del self._handles[handle.get_type(), handle.get_id()]
+        key = (handle.account, handle.network)
+        if self._account_handles.get(key) is handle:
+            del self._account_handles[key]
+        if handle._contact is not None:
+            self._contact_handles.pop(handle._contact, None)
+        self._unknown_contacts.discard(key)
+        self._caps.pop(handle, None)
+        self._contact_caps.pop(handle, None)
+        self._invalidate_contact_attributes(handle)
+
     def is_valid_handle_name(self, handle_type, handle_name):
         """Make sure the name is valid for this type of handle."""
         if handle_type == telepathy.HANDLE_TYPE_CONTACT:
@@ -250,7 +481,7 @@ class ButterflyConnection(telepathy.server.Connection,
         """Normalize handle name so the name is consistent everywhere."""
         if not self.is_valid_handle_name(handle_type, handle_name):
             raise telepathy.InvalidHandle('TargetID %s not valid for type %d' %
-                (name, handle_type))
+                (handle_name, handle_type))
         if handle_type == telepathy.HANDLE_TYPE_CONTACT:
             return handle_name.lower().strip()
         return handle_name
@@ -259,10 +490,96 @@ class ButterflyConnection(telepathy.server.Connection,
         """Build handle name for contact and ensure handle."""
         if contact is None:
             return telepathy.NoneHandler()
+        handle = self._find_contact_handle(contact)
+        if handle is None:
+            handle_type = telepathy.HANDLE_TYPE_CONTACT
+            handle = self.create_handle(handle_type,
+                    self._contact_handle_name(contact), contact=contact)
+        return handle
+
+    def ensure_contact_handles(self, contacts):
+        """Ensure handles for many contacts at once, without logging each
+        new handle. Return a contact -> handle dict."""
+        handles = {}
+        missing = []
+        for contact in contacts:
+            handle = self._find_contact_handle(contact)
+            if handle is None:
+                missing.append(contact)
+            else:
+                handles[contact] = handle
+
+        # Allocate all the ids we need in one go
         handle_type = telepathy.HANDLE_TYPE_CONTACT
+        handle_id = self._allocate_handle_ids(len(missing))
+        for contact in missing:
+            # The same account can appear more than once
+            handle = self._find_contact_handle(contact)
+            if handle is None:
+                handle = self._add_handle(handle_type, handle_id,
+                        self._contact_handle_name(contact), contact=contact)
+                handle_id += 1
+            handles[contact] = handle
+
+        if missing:
+            logger.info("New Handles for %d contacts" % len(missing))
+        return handles
+
+    def _find_contact_handle(self, contact):
+        """Return the existing handle of contact, or None."""
+        handle_ref = self._contact_handles.get(contact)
+        if handle_ref is not None:
+            handle = handle_ref()
+            if handle is not None:
+                return handle
+
+        key = (contact.account.lower(), contact.network_id)
+        handle = self._account_handles.get(key)
+        if handle is not None:
+            self._contact_handles[contact] = weakref.ref(handle)
+            # papyon can create contacts for strangers without telling the
+            # address book handlers, attach the one we were given to a handle
+            # that failed its lookup so far
+            if handle._contact is None:
+                handle._contact = contact
+                self._unknown_contacts.discard(key)
+                self._invalidate_contact_attributes(handle)
+        return handle
+
+    def _contact_handle_name(self, contact):
         extension = network_to_extension.get(contact.network_id, "")
-        handle_name = contact.account.lower() + extension
-        return self.ensure_handle(handle_type, handle_name, contact=contact)
+        return contact.account.lower() + extension
+
+    def _forget_contact_lookups(self, contact):
+        """Forget what we cached about a contact the address book just
+        added or deleted."""
+        key = (contact.account.lower(), contact.network_id)
+        self._unknown_contacts.discard(key)
+        handle = self._account_handles.get(key)
+        if handle is not None:
+            self._invalidate_contact_attributes(handle)
+
+    def find_group(self, group_name):
+        """Return the papyon group with the given name, ignoring case."""
+        # Microsoft seems to like case insensitive stuff
+        key = group_name.lower()
+        group = self._groups_by_name.get(key, None)
+        if group is None:
+            # The address book event may not have reached us yet if another
+            # handler of on_addressbook_group_added is asking
+            for candidate in self.msn_client.address_book.groups:
+                if candidate.name.decode("utf-8").lower() == key:
+                    self._index_group(candidate)
+                    return candidate
+        return group
+
+    def _index_group(self, group):
+        self._groups_by_name[group.name.decode("utf-8").lower()] = group
+
+    def _unindex_group(self, group):
+        for name, indexed_group in self._groups_by_name.items():
+            if indexed_group is group:
+                del self._groups_by_name[name]
 
     def Connect(self):
         if self._status == telepathy.CONNECTION_STATUS_DISCONNECTED:
@@ -280,6 +597,16 @@ class ButterflyConnection(telepathy.server.Connection,
 
     def _disconnected(self):
         logger.info("Disconnected")
+        if self._sweep_source is not None:
+            gobject.source_remove(self._sweep_source)
+            self._sweep_source = None
+        self._presence_aggregator.cancel()
+        self._profile_publisher.cancel()
+        self._alias_writes.cancel()
+        self._stop_populating_capabilities()
+        self._attribute_changes.cancel()
+        self._avatar_fetcher.clear()
+        self._stop_avatar_prefetch()
         self.StatusChanged(telepathy.CONNECTION_STATUS_DISCONNECTED,
                 self.__disconnect_reason)
         self._channel_manager.close()
@@ -287,7 +614,8 @@ class ButterflyConnection(telepathy.server.Connection,
 
     def GetInterfaces(self):
         # The self._interfaces set is only ever touched in ButterflyConnection.__init__,
-        # where connection interfaces are added.
+        # where connection interfaces are added, and the legacy Presence and
+        # Capabilities interfaces removed if they were not wanted.
 
         # The mail notification interface is added then too, but also removed in its
         # ButterflyMailNotification.__init__ because it might not actually be available.
@@ -340,6 +668,17 @@ class ButterflyConnection(telepathy.server.Connection,
             self.StatusChanged(telepathy.CONNECTION_STATUS_CONNECTING,
                     telepathy.CONNECTION_STATUS_REASON_REQUESTED)
         elif state == papyon.event.ClientState.SYNCHRONIZED:
+            # Lookups done before the address book was synchronized are
+            # meaningless now.
+            self._unknown_contacts.clear()
+            self._invalidate_all_contact_attributes()
+
+            # Create the handles of the whole roster at once, the list
+            # channels and _populate_capabilities share them until we are
+            # done synchronizing.
+            self._roster_handles = self.ensure_contact_handles(
+                    self.msn_client.address_book.contacts)
+
             handle = self.ensure_handle(telepathy.HANDLE_TYPE_LIST, 'subscribe')
             props = self._generate_props(telepathy.CHANNEL_TYPE_CONTACT_LIST,
                 handle, False)
@@ -365,6 +704,10 @@ class ButterflyConnection(telepathy.server.Connection,
             #    handle, False)
             #self._channel_manager.channel_for_props(props, signal=True)
 
+            self._groups_by_name.clear()
+            for group in self.msn_client.address_book.groups:
+                self._index_group(group)
+
             for group in self.msn_client.address_book.groups:
                 handle = self.ensure_handle(telepathy.HANDLE_TYPE_GROUP,
                         group.name.decode("utf-8"))
@@ -372,7 +715,12 @@ class ButterflyConnection(telepathy.server.Connection,
                     telepathy.CHANNEL_TYPE_CONTACT_LIST, handle, False)
                 self._channel_manager.channel_for_props(props, signal=True)
         elif state == papyon.event.ClientState.OPEN:
-            self._populate_capabilities()
+            self._start_populating_capabilities()
+            if self._prefetch_avatars:
+                self._schedule_avatar_prefetch()
+            if self._sweep_source is None:
+                self._sweep_source = gobject.timeout_add_seconds(
+                        HANDLE_SWEEP_INTERVAL, self._sweep_handles)
             if self._client.profile.profile['EmailEnabled'] == '1':
                 self.enable_mail_notification_interface()
             self.StatusChanged(telepathy.CONNECTION_STATUS_CONNECTED,
@@ -380,15 +728,14 @@ class ButterflyConnection(telepathy.server.Connection,
             presence = self._initial_presence
             message = self._initial_personal_message
             if presence is not None:
-                self._client.profile.presence = presence
+                self._profile_publisher.set(presence=presence)
             if message is not None:
-                self._client.profile.personal_message = message
-            self._client.profile.end_point_name = "PAPYON"
+                self._profile_publisher.set(personal_message=message)
+            self._profile_publisher.set(end_point_name="PAPYON")
+            self._profile_publisher.flush()
 
             if (presence is not None) or (message is not None):
-                self._presence_changed(self._self_handle,
-                        self._client.profile.presence,
-                        self._client.profile.personal_message)
+                self._presence_changed(self._self_handle, force=True)
         elif state == papyon.event.ClientState.CLOSED:
             self._disconnected()
 
@@ -456,6 +803,28 @@ class ButterflyConnection(telepathy.server.Connection,
         channel = self._channel_manager.channel_for_props(props, signal=True,
                 call=session)
 
+    # papyon.event.AddressBookEventInterface
+    def on_addressbook_contact_added(self, contact):
+        self._forget_contact_lookups(contact)
+        ButterflyCapabilities.on_addressbook_contact_added(self, contact)
+
+    # papyon.event.AddressBookEventInterface
+    def on_addressbook_contact_deleted(self, contact):
+        self._forget_contact_lookups(contact)
+
+    # papyon.event.AddressBookEventInterface
+    def on_addressbook_group_added(self, group):
+        self._index_group(group)
+
+    # papyon.event.AddressBookEventInterface
+    def on_addressbook_group_deleted(self, group):
+        self._unindex_group(group)
+
+    # papyon.event.AddressBookEventInterface
+    def on_addressbook_group_renamed(self, group):
+        self._unindex_group(group)
+        self._index_group(group)
+
     # papyon.event.OfflineMessagesEventInterface
     def on_oim_messages_received(self, messages):
         # We got notified we received some offlines messages so we
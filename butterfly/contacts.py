@@ -19,12 +19,15 @@
 
 import logging
 import time
+import weakref
 
 import telepathy
 import telepathy.errors
 import papyon
 import dbus
 
+from butterfly.util.aggregator import Aggregator
+
 __all__ = ['ButterflyContacts']
 
 logger = logging.getLogger('Butterfly.Contacts')
@@ -48,57 +51,136 @@ class ButterflyContacts(
         papyon.event.ContactEventInterface.__init__(self, self.msn_client)
         papyon.event.ProfileEventInterface.__init__(self, self.msn_client)
 
+        self.attributes = dict(ButterflyContacts.attributes)
+        if not self._legacy_interfaces:
+            del self.attributes[telepathy.CONNECTION_INTERFACE_CAPABILITIES]
+
         dbus_interface = telepathy.CONNECTION_INTERFACE_CONTACTS
 
         self._implement_property_get(dbus_interface, \
                 {'ContactAttributeInterfaces' : self.get_contact_attribute_interfaces})
 
+        # Per-handle attribute getters, returning None if the attribute
+        # should be omitted for this handle
+        self._attribute_getters = {
+            telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE :
+                self._get_simple_presence,
+            telepathy.CONNECTION_INTERFACE_ALIASING : self._get_alias,
+            telepathy.CONNECTION_INTERFACE_AVATARS : self._get_avatar_token,
+            telepathy.CONNECTION_INTERFACE_CAPABILITIES :
+                self._get_handle_capabilities,
+            telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES :
+                self._get_handle_contact_capabilities
+            }
+
+        # handle -> {interface : attribute value}, entries are invalidated by
+        # the papyon events changing them
+        self._attribute_cache = weakref.WeakKeyDictionary()
+        # Interfaces whose getter keeps its own per-handle cache
+        self._uncached_attributes = set([
+            telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE])
+
+        # Signal the changes of these attributes, given a dict of handle ->
+        # value queued with _contact_attribute_changed
+        self._change_signallers = {
+            telepathy.CONNECTION_INTERFACE_ALIASING :
+                self._signal_aliases_changed,
+            telepathy.CONNECTION_INTERFACE_AVATARS :
+                self._signal_avatars_updated,
+            telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES :
+                self._signal_contact_capabilities_changed
+            }
+
+        # (interface, handle) -> value, signalled once per mainloop iteration
+        self._attribute_changes = Aggregator(self._signal_attribute_changes)
+
     # Overwrite the dbus attribute to get the sender argument
     @dbus.service.method(telepathy.CONNECTION_INTERFACE_CONTACTS, in_signature='auasb',
                             out_signature='a{ua{sv}}', sender_keyword='sender')
     def GetContactAttributes(self, handles, interfaces, hold, sender):
-        #InspectHandle already checks we're connected, the handles and handle type.
+        self.check_connected()
+
         supported_interfaces = set()
         for interface in interfaces:
-            if interface in self.attributes:
+            if interface == telepathy.CONNECTION:
+                continue
+            elif interface in self.attributes:
                 supported_interfaces.add(interface)
             else:
                 logger.debug("Ignoring unsupported interface %s" % interface)
 
+        # Resolve every handle once, this also checks they are all valid.
         handle_type = telepathy.HANDLE_TYPE_CONTACT
-        ret = dbus.Dictionary(signature='ua{sv}')
-        for handle in handles:
-            ret[handle] = dbus.Dictionary(signature='sv')
-
-        functions = {
-            telepathy.CONNECTION :
-                lambda x: zip(x, self.InspectHandles(handle_type, x)),
-            telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE :
-                lambda x: self.GetPresences(x).items(),
-            telepathy.CONNECTION_INTERFACE_ALIASING :
-                lambda x: self.GetAliases(x).items(),
-            telepathy.CONNECTION_INTERFACE_AVATARS :
-                lambda x: self.GetKnownAvatarTokens(x).items(),
-            telepathy.CONNECTION_INTERFACE_CAPABILITIES :
-                lambda x: self.GetCapabilities(x).items(),
-            telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES :
-                lambda x: self.GetContactCapabilities(x).items()
-            }
+        contacts = [self.handle(handle_type, handle_id) for handle_id in handles]
 
         #Hold handles if needed
         if hold:
             self.HoldHandles(handle_type, handles, sender)
 
+        requested = [(interface + '/' + self.attributes[interface], interface)
+                for interface in supported_interfaces]
+
         # Attributes from the interface org.freedesktop.Telepathy.Connection
         # are always returned, and need not be requested explicitly.
-        supported_interfaces.add(telepathy.CONNECTION)
+        contact_id = telepathy.CONNECTION + '/' + \
+                self.attributes[telepathy.CONNECTION]
 
-        for interface in supported_interfaces:
-            interface_attribute = interface + '/' + self.attributes[interface]
-            results = functions[interface](handles)
-            for handle, value in results:
-                ret[int(handle)][interface_attribute] = value
+        ret = dbus.Dictionary(signature='ua{sv}')
+        for handle in contacts:
+            attributes = dbus.Dictionary(signature='sv')
+            attributes[contact_id] = handle.get_name()
+            for attribute, interface in requested:
+                value = self._get_contact_attribute(handle, interface)
+                if value is not None:
+                    attributes[attribute] = value
+            ret[int(handle)] = attributes
         return ret
 
+    def _get_contact_attribute(self, handle, interface):
+        """Get one attribute of a handle, computing it only if it changed
+        since the last time it was asked for."""
+        if interface in self._uncached_attributes:
+            return self._attribute_getters[interface](handle)
+        cached = self._attribute_cache.get(handle)
+        if cached is None:
+            cached = self._attribute_cache[handle] = {}
+        if interface in cached:
+            return cached[interface]
+        value = cached[interface] = self._attribute_getters[interface](handle)
+        return value
+
+    def _invalidate_contact_attributes(self, handle, *interfaces):
+        """Forget the cached attributes of the given interfaces for this
+        handle, or all of them if no interface is given."""
+        if not interfaces:
+            self._attribute_cache.pop(handle, None)
+            return
+        cached = self._attribute_cache.get(handle)
+        if cached is not None:
+            for interface in interfaces:
+                cached.pop(interface, None)
+
+    def _invalidate_all_contact_attributes(self, *interfaces):
+        """Same as _invalidate_contact_attributes, for every handle."""
+        if not interfaces:
+            self._attribute_cache.clear()
+            return
+        for cached in self._attribute_cache.values():
+            for interface in interfaces:
+                cached.pop(interface, None)
+
+    def _contact_attribute_changed(self, handle, interface, value=None):
+        """Queue the signalling of a change of an attribute of this handle.
+        Changes queued for the same handle and interface before the next
+        mainloop iteration are merged, the last value winning."""
+        self._attribute_changes.add((interface, handle), value)
+
+    def _signal_attribute_changes(self, changes):
+        values = {}
+        for (interface, handle), value in changes.iteritems():
+            values.setdefault(interface, {})[handle] = value
+        for interface, handle_values in values.iteritems():
+            self._change_signallers[interface](handle_values)
+
     def get_contact_attribute_interfaces(self):
         return self.attributes.keys()
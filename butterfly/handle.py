@@ -22,13 +22,22 @@ import weakref
 import telepathy
 import papyon
 
-__all__ = ['ButterflyHandleFactory', 'network_to_extension']
+__all__ = ['ButterflyHandleFactory', 'network_to_extension', 'parse_contact_name']
 
 logger = logging.getLogger('Butterfly.Handle')
 
 network_to_extension = {papyon.NetworkID.EXTERNAL: "#yahoo"}
 
 
+def parse_contact_name(contact_name):
+    """Return the (account, network) pair designated by a contact handle
+    name, as built by ButterflyConnection.ensure_contact_handle."""
+    for network, extension in network_to_extension.items():
+        if contact_name.endswith(extension):
+            return contact_name[0:-len(extension)].lower(), network
+    return contact_name.lower(), papyon.NetworkID.MSN
+
+
 def ButterflyHandleFactory(connection, type, id, name, **kwargs):
     mapping = {telepathy.HANDLE_TYPE_CONTACT: ButterflyContactHandle,
                telepathy.HANDLE_TYPE_LIST: ButterflyListHandle,
@@ -39,6 +48,11 @@ def ButterflyHandleFactory(connection, type, id, name, **kwargs):
 
 
 class ButterflyHandle(telepathy.server.Handle):
+    # Every attribute set by telepathy.server.Handle and by us has a slot, so
+    # instances never get a __dict__ allocated even though the base class
+    # doesn't define __slots__.
+    __slots__ = ('_id', '_type', '_name', '_conn')
+
     def __init__(self, connection, id, handle_type, name):
         telepathy.server.Handle.__init__(self, id, handle_type, name)
         self._conn = weakref.proxy(connection)
@@ -54,42 +68,81 @@ class ButterflyHandle(telepathy.server.Handle):
 
 
 class ButterflyContactHandle(ButterflyHandle):
-    def __init__(self, connection, id, contact_name, contact=None):
+    __slots__ = ('_contact', 'account', 'network', '_pending_groups',
+            'pending_alias')
+
+    def __init__(self, connection, id, contact_name, contact=None,
+            account=None, network=None):
         handle_type = telepathy.HANDLE_TYPE_CONTACT
         handle_name = contact_name
         self._contact = contact
 
-        if contact is None:
-            contact_account = contact_name.lower()
-            contact_network = papyon.NetworkID.MSN
-            for network, extension in network_to_extension.items():
-                if contact_name.endswith(extension):
-                    contact_account = contact_name[0:-len(extension)]
-                    contact_network = network
-                    break
+        if contact is None and account is not None:
+            contact_account, contact_network = account, network
+        elif contact is None:
+            contact_account, contact_network = parse_contact_name(contact_name)
         else:
-            contact_account = contact.account
+            contact_account = contact.account.lower()
             contact_network = contact.network_id
 
+        # MSN accounts are their own handle name, share the string
+        if contact_account == handle_name:
+            contact_account = handle_name
+
         self.account = contact_account
         self.network = contact_network
-        self.pending_groups = set()
+        self._pending_groups = None
         self.pending_alias = None
         ButterflyHandle.__init__(self, connection, id, handle_type, handle_name)
 
     @property
     def contact(self):
         if self._contact is None:
+            key = (self.account, self.network)
             if self.account == self._conn._msn_client.profile.account.lower() and \
                     self.network == papyon.NetworkID.MSN:
                 self._contact = self._conn.msn_client.profile
-            else:
+            elif key not in self._conn._unknown_contacts:
                 self._contact = self._conn.msn_client.address_book.search_contact(
                         self.account, self.network)
+                # Don't search the address book again until it tells us
+                # about this contact (see on_addressbook_contact_added)
+                if self._contact is None:
+                    self._conn._unknown_contacts.add(key)
         return self._contact
 
+    @property
+    def pending_groups(self):
+        """Groups to add the contact to once it is in our address book.
+        This is a read-only view, use add_pending_group and friends to
+        modify it."""
+        if self._pending_groups is None:
+            return frozenset()
+        return self._pending_groups
+
+    def add_pending_group(self, group):
+        if self._pending_groups is None:
+            self._pending_groups = set()
+        self._pending_groups.add(group)
+
+    def discard_pending_group(self, group):
+        if self._pending_groups is not None:
+            self._pending_groups.discard(group)
+            if not self._pending_groups:
+                self._pending_groups = None
+
+    def pop_pending_groups(self):
+        """Return the list of pending groups and forget about them."""
+        groups = self._pending_groups
+        self._pending_groups = None
+        if groups is None:
+            return []
+        return list(groups)
+
 
 class ButterflyListHandle(ButterflyHandle):
+    __slots__ = ()
+
     def __init__(self, connection, id, list_name):
         handle_type = telepathy.HANDLE_TYPE_LIST
         handle_name = list_name
@@ -97,6 +150,8 @@ class ButterflyListHandle(ButterflyHandle):
 
 
 class ButterflyGroupHandle(ButterflyHandle):
+    __slots__ = ()
+
     def __init__(self, connection, id, group_name):
         handle_type = telepathy.HANDLE_TYPE_GROUP
         handle_name = group_name
@@ -104,8 +159,4 @@ class ButterflyGroupHandle(ButterflyHandle):
 
     @property
     def group(self):
-        for group in self._conn.msn_client.address_book.groups:
-            # Microsoft seems to like case insensitive stuff
-            if group.name.decode("utf-8").lower() == self.name.lower():
-                return group
-        return None
+        return self._conn.find_group(self.name)
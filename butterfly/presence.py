@@ -21,6 +21,7 @@
 
 import logging
 import time
+import weakref
 
 import dbus
 import telepathy
@@ -28,12 +29,20 @@ import telepathy.constants
 import telepathy.errors
 import papyon
 
-from butterfly.util.decorator import async
+from butterfly.util.aggregator import Aggregator
 
 __all__ = ['ButterflyPresence']
 
 logger = logging.getLogger('Butterfly.Presence')
 
+# Presence changes are batched for this many milliseconds before being
+# signalled, 0 meaning until the mainloop is idle.
+PRESENCE_CHANGED_DELAY = 0
+
+# Maximum number of presence changes signalled per mainloop iteration, not
+# counting the contacts we are talking to.
+PRESENCE_CHANGED_CHUNK_SIZE = 200
+
 
 class ButterflyPresenceMapping(object):
     ONLINE = 'available'
@@ -93,6 +102,17 @@ class ButterflyPresence(telepathy.server.ConnectionInterfacePresence,
         papyon.event.ContactEventInterface.__init__(self, self.msn_client)
         papyon.event.ProfileEventInterface.__init__(self, self.msn_client)
 
+        self._presence_aggregator = Aggregator(self._presences_changed,
+                PRESENCE_CHANGED_DELAY, self._urgent_presence_handles,
+                PRESENCE_CHANGED_CHUNK_SIZE)
+
+        # handle -> ((papyon presence, personal message), SimplePresence
+        # struct), the struct is only rebuilt when the contact changes.
+        self._presence_structs = weakref.WeakKeyDictionary()
+        # papyon presence -> struct, shared by the contacts without
+        # personal message
+        self._bare_presence_structs = {}
+
         self._implement_property_get(
             telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE, {
                 'Statuses' : lambda: self._protocol.statuses
@@ -153,27 +173,21 @@ class ButterflyPresence(telepathy.server.ConnectionInterfacePresence,
         logger.info("Setting Presence to '%s'" % presence)
         logger.info("Setting Personal message to '%s'" % message)
 
-        message.encode("utf-8")
+        message = message.encode("utf-8")
 
         if self._status != telepathy.CONNECTION_STATUS_CONNECTED:
             self._initial_presence = presence
             self._initial_personal_message = message
         else:
-            self.msn_client.profile.personal_message = message
-            self.msn_client.profile.presence = presence
+            self._profile_publisher.set(personal_message=message,
+                    presence=presence)
 
     def get_presences(self, contacts):
         presences = {}
         for handle_id in contacts:
             handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, handle_id)
-            contact = handle.contact
-
-            if contact is not None:
-                presence = ButterflyPresenceMapping.to_telepathy[contact.presence]
-                personal_message = unicode(contact.personal_message, "utf-8")
-            else:
-                presence = ButterflyPresenceMapping.OFFLINE
-                personal_message = u""
+            presence_type, presence, personal_message = \
+                    self._get_simple_presence(handle)
 
             arguments = {}
             if personal_message:
@@ -206,57 +220,96 @@ class ButterflyPresence(telepathy.server.ConnectionInterfacePresence,
             self._initial_presence = presence
             self._initial_personal_message = message
         else:
-            self.msn_client.profile.personal_message = message
-            self.msn_client.profile.presence = presence
+            self._profile_publisher.set(personal_message=message,
+                    presence=presence)
 
     def get_simple_presences(self, contacts):
         presences = dbus.Dictionary(signature='u(uss)')
         for handle_id in contacts:
             handle = self.handle(telepathy.HANDLE_TYPE_CONTACT, handle_id)
-            contact = handle.contact
+            presences[handle] = self._get_simple_presence(handle)
+        return presences
 
-            if contact is not None:
-                presence = ButterflyPresenceMapping.to_telepathy[contact.presence]
-                personal_message = unicode(contact.personal_message, "utf-8")
-            else:
-                presence = ButterflyPresenceMapping.OFFLINE
-                personal_message = u""
+    def _get_simple_presence(self, handle):
+        """Get the SimplePresence struct of one handle"""
+        contact = handle.contact
 
-            presence_type = ButterflyPresenceMapping.to_presence_type[presence]
+        if contact is not None:
+            key = (contact.presence, contact.personal_message)
+        else:
+            key = (papyon.Presence.OFFLINE, "")
 
-            presences[handle] = dbus.Struct((presence_type, presence,
-                personal_message), signature='uss')
-        return presences
+        cached = self._presence_structs.get(handle)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        struct = self._build_simple_presence(*key)
+        self._presence_structs[handle] = (key, struct)
+        return struct
+
+    def _build_simple_presence(self, papyon_presence, personal_message):
+        if not personal_message:
+            struct = self._bare_presence_structs.get(papyon_presence)
+            if struct is not None:
+                return struct
+
+        presence = ButterflyPresenceMapping.to_telepathy[papyon_presence]
+        presence_type = ButterflyPresenceMapping.to_presence_type[presence]
+        struct = dbus.Struct((presence_type, presence,
+                unicode(personal_message, "utf-8")), signature='uss')
+
+        if not personal_message:
+            self._bare_presence_structs[papyon_presence] = struct
+        return struct
 
     # papyon.event.ContactEventInterface
     def on_contact_presence_changed(self, contact):
         handle = self.ensure_contact_handle(contact)
         logger.info("Contact %s presence changed to '%s'" % (unicode(handle),
             contact.presence))
-        self._presence_changed(handle, contact.presence, contact.personal_message)
+        self._presence_changed(handle)
 
     # papyon.event.ContactEventInterface
     on_contact_personal_message_changed = on_contact_presence_changed
 
     # papyon.event.ProfileEventInterface
     def on_profile_presence_changed(self):
-        profile = self.msn_client.profile
-        self._presence_changed(self._self_handle,
-                profile.presence, profile.personal_message)
+        self._presence_changed(self._self_handle)
 
     # papyon.event.ProfileEventInterface
     on_profile_personal_message_changed = on_profile_presence_changed
 
-    @async
-    def _presence_changed(self, handle, presence, personal_message):
-        presence = ButterflyPresenceMapping.to_telepathy[presence]
-        presence_type = ButterflyPresenceMapping.to_presence_type[presence]
-        personal_message = unicode(personal_message, "utf-8")
-
-        self.PresencesChanged({handle: (presence_type, presence, personal_message)})
-
-        arguments = {}
-        if personal_message:
-            arguments = {'message' : personal_message}
+    def _presence_changed(self, handle, force=False):
+        """Queue the signalling of the presence of this handle, unless it
+        is the one we last gave out."""
+        cached = self._presence_structs.get(handle)
+        struct = self._get_simple_presence(handle)
+        if force or cached is None or cached[1] is not struct:
+            self._presence_aggregator.add(handle, struct)
+
+    def _urgent_presence_handles(self):
+        """Handles whose presence changes must not wait behind the rest of
+        the roster: the contacts we have channels with and the ones clients
+        explicitly asked for."""
+        handles = self._channel_manager.contact_channel_handles()
+        handles.update(self._requested_handles)
+        handles.add(self._self_handle)
+        return handles
+
+    def _presences_changed(self, changes):
+        logger.debug("Signalling presence changes of %d contacts" %
+                len(changes))
+        self.PresencesChanged(changes)
+
+        if not self._legacy_interfaces:
+            return
 
-        self.PresenceUpdate({handle: (int(time.time()), {presence:arguments})})
+        presences = {}
+        timestamp = int(time.time())
+        for handle, (presence_type, presence, personal_message) in \
+                changes.iteritems():
+            arguments = {}
+            if personal_message:
+                arguments = {'message' : personal_message}
+            presences[handle] = (timestamp, {presence:arguments})
+        self.PresenceUpdate(presences)
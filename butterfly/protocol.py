@@ -59,11 +59,17 @@ class ButterflyProtocol(telepathy.server.Protocol,
             'https-proxy-username' : 's',
             'https-proxy-password' : 's',
             'http-method' : 'b',
+            'legacy-interfaces' : 'b',
+            'downscale-avatars' : 'b',
+            'prefetch-avatars' : 'b',
             }
     _parameter_defaults = {
             'server' : u'messenger.hotmail.com',
             'port' : 1863,
-            'http-method' : False
+            'http-method' : False,
+            'legacy-interfaces' : True,
+            'downscale-avatars' : False,
+            'prefetch-avatars' : False
             }
 
     _requestable_channel_classes = [
@@ -0,0 +1,89 @@
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import logging
+import weakref
+
+from butterfly.util.aggregator import Aggregator
+
+__all__ = ['ButterflyProfilePublisher']
+
+logger = logging.getLogger('Butterfly.ProfilePublisher')
+
+# Milliseconds during which changes to our profile are merged before being
+# sent to the server
+PROFILE_PUBLISH_DELAY = 1000
+
+
+class ButterflyProfilePublisher(object):
+    """Publish the changes made to our own profile.
+
+    Each profile attribute assignment costs a server command, so the changes
+    made during PROFILE_PUBLISH_DELAY are merged, keeping only the last value
+    of each attribute, and the ones leaving the attribute as it was are
+    dropped."""
+
+    # In the order they are sent
+    attributes = ('personal_message', 'presence', 'display_name',
+            'end_point_name')
+
+    def __init__(self, connection, delay=PROFILE_PUBLISH_DELAY):
+        self._conn = weakref.proxy(connection)
+        self._aggregator = Aggregator(self._publish, delay)
+        self.requested = 0
+        self.published = 0
+
+    @property
+    def saved(self):
+        """Number of server commands avoided so far"""
+        return self.requested - len(self._aggregator) - self.published
+
+    def get(self, name):
+        """Get a profile attribute, including the changes not published
+        yet."""
+        if name in self._aggregator:
+            return self._aggregator.get(name)
+        return getattr(self._conn.msn_client.profile, name)
+
+    def set(self, **changes):
+        for name, value in changes.iteritems():
+            if name not in self.attributes:
+                raise AttributeError("Can't publish profile attribute %s" %
+                        name)
+            self.requested += 1
+            self._aggregator.add(name, value)
+
+    def flush(self):
+        """Publish the pending changes now."""
+        self._aggregator.flush()
+
+    def cancel(self):
+        self._aggregator.cancel()
+
+    def _publish(self, changes):
+        profile = self._conn.msn_client.profile
+        for name in self.attributes:
+            if name not in changes:
+                continue
+            value = changes[name]
+            if getattr(profile, name) == value:
+                continue
+            setattr(profile, name, value)
+            self.published += 1
+        logger.debug("Published %d profile changes, %d commands saved" %
+                (self.published, self.saved))
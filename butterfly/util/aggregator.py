@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Coalesce bursts of changes into a single batch"""
+
+import gobject
+
+__all__ = ['Aggregator']
+
+
+class Aggregator(object):
+    """Collect values by key and hand them over to a callback in one batch.
+
+    The callback receives a dict of key => value where, for each key, only
+    the last value added before the flush is kept. It is run at the next
+    mainloop idle state, or delay milliseconds after the first value of the
+    batch was added if delay is not 0.
+
+    If urgent is given, it is called at each flush and returns the keys to
+    hand over first, in a batch of their own. If chunk_size is not 0, at
+    most chunk_size other keys are handed over per mainloop iteration, the
+    rest being kept pending for the next idle states."""
+
+    def __init__(self, callback, delay=0, urgent=None, chunk_size=0):
+        self._callback = callback
+        self._delay = delay
+        self._urgent = urgent
+        self._chunk_size = chunk_size
+        self._pending = {}
+        self._source = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def get(self, key, default=None):
+        return self._pending.get(key, default)
+
+    def add(self, key, value):
+        self._pending[key] = value
+        if self._source is None:
+            if self._delay:
+                self._source = gobject.timeout_add(self._delay, self._flush)
+            else:
+                self._source = gobject.idle_add(self._flush)
+
+    def discard(self, key):
+        self._pending.pop(key, None)
+
+    def flush(self):
+        """Run the callback now with whatever is pending."""
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            self._callback(pending)
+
+    def cancel(self):
+        """Drop everything pending without running the callback."""
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+        self._pending = {}
+
+    def _flush(self):
+        self._source = None
+        pending, self._pending = self._pending, {}
+
+        urgent = {}
+        if self._urgent is not None:
+            for key in self._urgent():
+                if key in pending:
+                    urgent[key] = pending.pop(key)
+
+        if self._chunk_size and len(pending) > self._chunk_size:
+            for key in pending.keys()[self._chunk_size:]:
+                self._pending[key] = pending.pop(key)
+            self._source = gobject.idle_add(self._flush)
+
+        if urgent:
+            self._callback(urgent)
+        if pending:
+            self._callback(pending)
+        return False
@@ -26,7 +26,7 @@ import time
 import gobject
 
 __all__ = ['decorator', 'rw_property', 'deprecated', 'unstable', 'async',
-        'throttled']
+        'throttled', 'time_sliced', 'TimeSlicedJob']
 
 
 def decorator(function):
@@ -124,3 +124,54 @@ class throttled(object):
         return new_function
 
 
+class TimeSlicedJob(object):
+    """A job started by a time_sliced function, cancel() stops it before
+    its next slice."""
+
+    def __init__(self, iterator, budget):
+        self._iterator = iterator
+        self._budget = budget
+        self._source = gobject.idle_add(self._run_slice)
+
+    def is_running(self):
+        return self._source is not None
+
+    def cancel(self):
+        if self._source is not None:
+            gobject.source_remove(self._source)
+            self._source = None
+
+    def _run_slice(self):
+        deadline = time.time() + self._budget
+        try:
+            # Always make progress, even with a budget too small for a
+            # single step
+            self._iterator.next()
+            while time.time() < deadline:
+                self._iterator.next()
+        except StopIteration:
+            self._source = None
+            return False
+        return True
+
+
+class time_sliced(object):
+    """Run a generator function in the mainloop idle states, resuming it
+    for at most budget milliseconds per mainloop iteration so that a long
+    job doesn't block the other events. Every yield is a point where the
+    job may be suspended. The decorated function returns a TimeSlicedJob
+    which can be cancelled."""
+
+    def __init__(self, budget=20):
+        self._budget = budget / 1000.0
+
+    def __call__(self, func):
+        budget = self._budget
+
+        def new_function(*args, **kwargs):
+            return TimeSlicedJob(func(*args, **kwargs), budget)
+
+        new_function.__name__ = func.__name__
+        new_function.__doc__ = func.__doc__
+        new_function.__dict__.update(func.__dict__)
+        return new_function
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# telepathy-butterfly - an MSN connection manager for Telepathy
+#
+# Copyright (C) 2010 Collabora Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+#
+
+"""Run work outside of the mainloop thread"""
+
+import logging
+import threading
+import Queue
+
+import gobject
+
+__all__ = ['WorkerPool']
+
+logger = logging.getLogger('Butterfly.Worker')
+
+
+class WorkerPool(object):
+    """Run functions in a few worker threads, handing their result over to
+    a callback in the mainloop thread.
+
+    The threads are started on first use. gobject.threads_init() must have
+    been called."""
+
+    def __init__(self, size=2):
+        self._size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def run(self, func, args, callback, errback=None):
+        """Call func(*args) in a worker thread, then callback(result), or
+        errback(exception) if it raised, at the next mainloop idle state."""
+        if not self._threads:
+            for i in range(self._size):
+                thread = threading.Thread(target=self._work,
+                        name="butterfly-worker-%d" % i)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put((func, args, callback, errback))
+
+    def _work(self):
+        while True:
+            func, args, callback, errback = self._queue.get()
+            try:
+                result = func(*args)
+            except Exception, e:
+                if errback is None:
+                    logger.exception("Worker function %s failed" %
+                            func.__name__)
+                else:
+                    gobject.idle_add(self._call, errback, e)
+            else:
+                gobject.idle_add(self._call, callback, result)
+
+    def _call(self, callback, result):
+        callback(result)
+        return False